@@ -3,23 +3,114 @@
 """
 This checks the last frame in the image for a blank frame. Blank frames
 indicate an OMERO import failure.
+
+The plane scanning throughput can be measured offline using synthetic pixel
+data by running:
+
+    ./Check_Images.py benchmark [max plane size]
+
+The default maximum plane size is 4096. Larger sizes (up to 16384) must be
+requested explicitly as they need several GB of memory.
 """
 
+import os
 import sys
+import csv
 import locale
+import hashlib
+import time
+import sqlite3
+import tempfile
+import threading
+import Queue
+import collections
+import functools
+import itertools
+import numpy
 try:
     locale.setlocale(locale.LC_ALL, 'en_GB')
 except:
     pass
 
+import omero
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway
+from omero.gateway import BlitzGateway, CommentAnnotationWrapper
 from omero.rtypes import *  # noqa
 
 PARAM_DATATYPE = "Data_Type"
 PARAM_IDS = "IDs"
 PARAM_ALL_IMAGES = "All_Images"
 PARAM_READABLE = "Readable_Bytes"
+PARAM_DEEP_SCAN = "Deep_Scan"
+PARAM_TILE_SIZE = "Tile_Size"
+PARAM_MAX_FAILURES = "Max_Failures"
+PARAM_LOCATE = "Locate_Truncation"
+PARAM_WORKERS = "Workers"
+PARAM_CACHE = "Use_Cache"
+PARAM_RECHECK = "Recheck"
+PARAM_CHECKSUM = "Verify_Checksums"
+PARAM_STATS = "Use_Stored_Stats"
+PARAM_TAIL_PROBE = "Tail_Probe"
+PARAM_TAIL_ROWS = "Tail_Rows"
+PARAM_DUPLICATES = "Detect_Duplicates"
+PARAM_PIPELINE = "Pipeline_Depth"
+PARAM_AUDIT = "Audit"
+
+# Default edge length of the tiles streamed during a deep scan
+DEFAULT_TILE_SIZE = 1024
+
+# Default number of rows read from the bottom of the plane by the tail probe
+DEFAULT_TAIL_ROWS = 16
+
+# Number of pixels sampled for the fingerprint of a plane
+FINGERPRINT_SAMPLES = 4096
+
+# Map the OMERO pixel type to the numpy data type
+PIXEL_DTYPES = {
+    'int8': numpy.int8, 'uint8': numpy.uint8,
+    'int16': numpy.int16, 'uint16': numpy.uint16,
+    'int32': numpy.int32, 'uint32': numpy.uint32,
+    'float': numpy.float32, 'double': numpy.float64,
+}
+
+# Location of the verification cache of each user (keyed by user ID)
+CACHE_FILE = "~/.omero/check_images_%d.db"
+
+# File name of the combined audit report attached to the script output
+AUDIT_FILE_NAME = "image_audit.csv"
+
+# Number of IDs used in each query of an 'in' clause
+BATCH_SIZE = 500
+
+# Namespace of the annotation holding the plane checksums of an image
+CHECKSUM_NS = "gdsc.sussex.ac.uk/check_images/plane_sha1"
+
+# Namespace of the combined audit report
+AUDIT_NS = "gdsc.sussex.ac.uk/check_images/audit"
+
+# The image details used to build the report
+ImageInfo = collections.namedtuple(
+    'ImageInfo',
+    'id name pixels_id x y z c t pixels_type dataset project '
+    'plate_id plate screen archived dimension_order')
+
+PREFETCH_QUERY = (
+    "select i.id, i.name, p.id, p.sizeX, p.sizeY, p.sizeZ, p.sizeC, "
+    "p.sizeT, pt.value, ds.name, pr.name, plate.id, plate.name, sc.name, "
+    "i.archived, do.value "
+    "from Image i join i.pixels p join p.pixelsType pt "
+    "join p.dimensionOrder do "
+    "left outer join i.datasetLinks dl left outer join dl.parent ds "
+    "left outer join ds.projectLinks pl left outer join pl.parent pr "
+    "left outer join i.wellSamples ws left outer join ws.well w "
+    "left outer join w.plate plate "
+    "left outer join plate.screenLinks sl left outer join sl.parent sc "
+    "where i.id in (:ids) order by i.id, ds.id, pr.id")
+
+STATS_QUERY = (
+    "select p.id, index(ch), si.globalMin, si.globalMax "
+    "from Pixels p join p.channels ch join ch.statsInfo si "
+    "where p.id in (:ids)")
 
 
 def bytes_per_pixel(pixel_type):
@@ -109,55 +200,1337 @@ def convert_raw(number, verbosity=100):
 
 
 def has_data(plane):
-    for a in plane:
-        for b in a:
-            if b != 0:
-                return True
-    return False
+    """
+    Return True if the plane contains any non-zero pixel
+
+    @param plane:  The 2D numpy array of pixel data
+    """
+    return bool(numpy.any(plane))
+
+
+def plane_stats(plane):
+    """
+    Compute the data statistics of the plane using vectorised operations.
+    Returns a tuple of (non_zero, min, max, zero_rows) where non_zero is the
+    count of non-zero pixels and zero_rows is the fraction of rows that
+    contain only zeros.
+
+    @param plane:  The 2D numpy array of pixel data
+    """
+    plane = numpy.asarray(plane)
+    if plane.size == 0:
+        return (0, 0, 0, 1.0)
+    mask = plane != 0
+    non_zero = int(numpy.count_nonzero(mask))
+    if plane.ndim > 1:
+        zero_rows = 1.0 - numpy.count_nonzero(mask.any(axis=1)) / float(
+            plane.shape[0])
+    else:
+        zero_rows = non_zero and 0.0 or 1.0
+    return (non_zero, plane.min(), plane.max(), zero_rows)
+
+
+def format_stats(stats):
+    """Format the plane statistics for the report"""
+    (non_zero, p_min, p_max, zero_rows) = stats
+    return "nz=%d,min=%s,max=%s,zero_rows=%.1f%%" % (
+        non_zero, p_min, p_max, 100.0 * zero_rows)
+
+
+def plane_tiles(size_x, size_y, tile_size):
+    """
+    Generate the (x, y, w, h) tiles that cover a plane
+
+    @param size_x:     The plane width
+    @param size_y:     The plane height
+    @param tile_size:  The maximum tile edge length
+    """
+    for ty in range(0, size_y, tile_size):
+        h = min(tile_size, size_y - ty)
+        for tx in range(0, size_x, tile_size):
+            yield (tx, ty, min(tile_size, size_x - tx), h)
+
+
+def deep_scan(pixels, size, params):
+    """
+    Stream every Z/C/T plane of the image in tiles and check each plane for
+    pixel data. The remaining tiles of a plane are skipped as soon as data is
+    found so only blank planes are read in full. Scanning stops once the
+    maximum number of blank planes has been found.
+
+    Returns a tuple of (ok, message).
+
+    @param pixels: The PixelsWrapper object
+    @param size:   The image dimensions (x, y, c, z, t)
+    @param params: The script parameters
+    """
+    (x, y, c, z, t) = size
+    tile_size = max(1, params.get(PARAM_TILE_SIZE, DEFAULT_TILE_SIZE))
+    max_failures = params.get(PARAM_MAX_FAILURES, 1)
+    tiles = list(plane_tiles(x, y, tile_size))
+
+    # Shared state between the tile generator and the consumer
+    state = {'data': False, 'planes': 0, 'blank': 0, 'first': None}
+
+    def zct_tile_list():
+        for pz in range(z):
+            for pc in range(c):
+                for pt in range(t):
+                    state['data'] = False
+                    state['planes'] += 1
+                    for tile in tiles:
+                        if state['data']:
+                            break
+                        yield (pz, pc, pt, tile)
+                    if not state['data']:
+                        state['blank'] += 1
+                        if state['first'] is None:
+                            state['first'] = (pz, pc, pt)
+                        if max_failures and state['blank'] >= max_failures:
+                            return
+
+    for tile in pixels.getTiles(zct_tile_list()):
+        if has_data(tile):
+            state['data'] = True
+
+    msg = "Deep scan %d/%d plane%s : %d blank" % (
+        state['planes'], z * c * t, state['planes'] != 1 and 's' or '',
+        state['blank'])
+    if state['first']:
+        msg += " : first blank z%d,c%d,t%d" % tuple(
+            [i + 1 for i in state['first']])
+    return (not state['blank'], msg)
+
+
+def tail_probe(pixels, size, params):
+    """
+    Read the bottom rows of the final plane of each channel in tiles and
+    check they contain data. A partially written plane has data in the top
+    rows and zeros in the trailing rows. The remaining tiles of a channel
+    are skipped as soon as data is found.
+
+    Returns a tuple of (ok, message).
+
+    @param pixels: The PixelsWrapper object
+    @param size:   The image dimensions (x, y, c, z, t)
+    @param params: The script parameters
+    """
+    (x, y, c, z, t) = size
+    tile_size = max(1, params.get(PARAM_TILE_SIZE, DEFAULT_TILE_SIZE))
+    rows = min(y, max(1, params.get(PARAM_TAIL_ROWS, DEFAULT_TAIL_ROWS)))
+    tiles = [(tx, y - rows, min(tile_size, x - tx), rows)
+             for tx in range(0, x, tile_size)]
+
+    # Shared state between the tile generator and the consumer
+    state = {'data': False}
+    blank = []
+
+    def zct_tile_list():
+        for pc in range(c):
+            state['data'] = False
+            for tile in tiles:
+                if state['data']:
+                    break
+                yield (z - 1, pc, t - 1, tile)
+            if not state['data']:
+                blank.append(pc)
+
+    for tile in pixels.getTiles(zct_tile_list()):
+        if has_data(tile):
+            state['data'] = True
+
+    msg = "Tail %d row%s" % (rows, rows != 1 and 's' or '')
+    if blank:
+        msg += " : blank " + ",".join(["c%d" % (i + 1) for i in blank])
+    return (not blank, msg)
+
+
+def fingerprint(plane):
+    """
+    Compute a cheap fingerprint of the plane from a strided sample of the
+    pixels
+
+    @param plane:  The 2D numpy array of pixel data
+    """
+    flat = numpy.ravel(plane)
+    stride = max(1, flat.size // FINGERPRINT_SAMPLES)
+    return hashlib.sha1(numpy.ascontiguousarray(flat[::stride])).digest()
+
+
+def full_hash(plane):
+    """Compute the hash of all the pixels in the plane"""
+    return hashlib.sha1(numpy.ascontiguousarray(plane)).digest()
+
+
+def find_duplicates(pixels, size):
+    """
+    Stream the planes of each channel in T then Z order and find runs of
+    identical consecutive planes. Planes are compared using a fingerprint of
+    sampled pixels; the full hash is computed only when the fingerprints
+    match. Only the previous plane is held in memory. Blank planes (e.g.
+    empty Z slices outside the sample) are not compared; missing data is
+    reported by the blank plane checks.
+
+    Returns a tuple of (ok, message).
+
+    @param pixels: The PixelsWrapper object
+    @param size:   The image dimensions (x, y, c, z, t)
+    """
+    (x, y, c, z, t) = size
+
+    def zct_list():
+        for pc in range(c):
+            for pt in range(t):
+                for pz in range(z):
+                    yield (pz, pc, pt)
+
+    runs = []
+    duplicates = 0
+    blank = 0
+    start = None
+    # The previous (zct, fingerprint, plane, full hash)
+    previous = None
+    for (zct, plane) in itertools.izip(zct_list(),
+                                       pixels.getPlanes(zct_list())):
+        if not has_data(plane):
+            blank += 1
+            if start is not None:
+                runs.append((start, previous[0]))
+                start = None
+            previous = None
+            continue
+        key = fingerprint(plane)
+        plane_hash = None
+        same = False
+        if previous and previous[0][1] == zct[1] and previous[1] == key:
+            plane_hash = full_hash(plane)
+            same = plane_hash == (previous[3] or full_hash(previous[2]))
+        if same:
+            duplicates += 1
+            if start is None:
+                start = previous[0]
+        elif start is not None:
+            runs.append((start, previous[0]))
+            start = None
+        previous = (zct, key, plane, plane_hash)
+    if start is not None:
+        runs.append((start, previous[0]))
+
+    msg = "Duplicates %d plane%s" % (duplicates, duplicates != 1 and 's' or '')
+    if blank:
+        msg += " (%d blank skipped)" % blank
+    if runs:
+        msg += " : " + ",".join(["c%d[z%d,t%d-z%d,t%d]" % (
+            first[1] + 1, first[0] + 1, first[2] + 1,
+            last[0] + 1, last[2] + 1) for (first, last) in runs])
+    return (not runs, msg)
+
+
+def last_index(size, probe):
+    """
+    Binary search for the last index in [0, size) where probe returns True.
+    Assumes the probe is True for a contiguous run from the first index
+    (i.e. the data was written in order until the import failed).
+    Returns -1 if the probe is False for the first index.
+
+    @param size:   The number of indices
+    @param probe:  Function taking an index and returning True if it has data
+    """
+    lo = -1
+    hi = size
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if probe(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def plane_position(index, size, order):
+    """
+    Return the (z, c, t) of the plane at the linear index
+
+    @param index:  The index of the plane in the dimension order
+    @param size:   The image dimensions (x, y, c, z, t)
+    @param order:  The dimension order, e.g. XYZCT
+    """
+    (x, y, c, z, t) = size
+    sizes = {'Z': z, 'C': c, 'T': t}
+    position = {}
+    for dim in order[2:]:
+        position[dim] = index % sizes[dim]
+        index //= sizes[dim]
+    return (position['Z'], position['C'], position['T'])
+
+
+def locate_truncation(pixels, size, order='XYZCT'):
+    """
+    Locate the last plane containing data using single-plane reads. A binary
+    search over the linear plane index in the dimension order of the pixels
+    (the order the planes are written during import) finds the last plane
+    with data.
+
+    Returns a message describing the truncation point.
+
+    @param pixels: The PixelsWrapper object
+    @param size:   The image dimensions (x, y, c, z, t)
+    @param order:  The dimension order of the pixels
+    """
+    (x, y, c, z, t) = size
+    reads = [0]
+
+    def probe(index):
+        reads[0] += 1
+        (pz, pc, pt) = plane_position(index, size, order)
+        return has_data(pixels.getPlane(pz, pc, pt))
+
+    last = last_index(z * c * t, probe)
+    if last < 0:
+        return "Truncated : no data (%d reads)" % reads[0]
+    (pz, pc, pt) = plane_position(last, size, order)
+    return "Truncated : last data z%d,c%d,t%d (%d reads)" % (
+        pz + 1, pc + 1, pt + 1, reads[0])
+
+
+def batches(items, size=BATCH_SIZE):
+    """
+    Split the items into lists of the given size
+
+    @param items:  The items (any iterable)
+    @param size:   The maximum batch size
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetch_images(conn, image_ids):
+    """
+    Load the name, pixel dimensions, pixel type, dataset and project names of
+    the images using one projection query per batch of IDs. If an image is in
+    multiple datasets the dataset with the lowest ID is used (as in
+    Image_Size). Returns a dictionary of ImageInfo keyed by image ID.
+
+    @param conn:       The BlitzGateway connection
+    @param image_ids:  The image IDs
+    """
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    query_service = conn.getQueryService()
+    infos = {}
+    for ids in batches(image_ids):
+        param = omero.sys.ParametersI()
+        param.addIds(ids)
+        for row in query_service.projection(PREFETCH_QUERY, param, ctx):
+            info = ImageInfo(*[unwrap(v) for v in row])
+            if info.id not in infos:
+                infos[info.id] = info
+    return infos
+
+
+def prefetch_stats(conn, infos, params):
+    """
+    Load the stored global (min, max) of the last channel of the images
+    using one projection query per batch. Returns a dictionary keyed by
+    pixels ID; images without statistics are missing. Returns an empty
+    dictionary if the stored statistics are not used.
+
+    @param conn:   The BlitzGateway connection
+    @param infos:  The ImageInfo of the images
+    @param params: The script parameters
+    """
+    stats = {}
+    if not params.get(PARAM_STATS) or params.get(PARAM_DEEP_SCAN):
+        return stats
+    last_channel = dict([(x.pixels_id, x.c - 1) for x in infos])
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    query_service = conn.getQueryService()
+    for ids in batches(last_channel.keys()):
+        param = omero.sys.ParametersI()
+        param.addIds(ids)
+        for row in query_service.projection(STATS_QUERY, param, ctx):
+            (pixels_id, channel, p_min, p_max) = [unwrap(v) for v in row]
+            if (channel == last_channel[pixels_id] and
+                    p_min is not None and p_max is not None):
+                stats[pixels_id] = (p_min, p_max)
+    return stats
+
+
+def stats_result(stats):
+    """
+    Decide if the final plane has data using the stored statistics of the
+    channel. If the channel minimum is above zero (or the maximum below zero)
+    then no pixel in any plane is zero; if the min and max are zero then all
+    pixels are zero. Returns True, False or None if the statistics are
+    ambiguous.
+
+    @param stats:  The stored (min, max) of the channel (can be None)
+    """
+    if stats is None:
+        return None
+    (p_min, p_max) = stats
+    if p_min > 0 or p_max < 0:
+        return True
+    if p_min == 0 and p_max == 0:
+        return False
+    return None
+
+
+def image_query(params):
+    """
+    Return the HQL queries selecting the IDs of the images defined in the
+    script parameters. Returns a tuple of (query, count_query, ids) where the
+    query selects the distinct image IDs above the :last parameter in
+    ascending order (for keyset paging) and ids is the value for the :ids
+    parameter (None if not used).
+
+    @param params: The script parameters
+    """
+    if params.get(PARAM_ALL_IMAGES):
+        return ("select i.id from Image i where i.id > :last order by i.id",
+                "select count(i.id) from Image i", None)
+    ids = params.get(PARAM_IDS, [0])
+    if params[PARAM_DATATYPE] == 'Dataset':
+        return ("select distinct l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids) and l.child.id > :last "
+                "order by l.child.id",
+                "select count(distinct l.child.id) from DatasetImageLink l "
+                "where l.parent.id in (:ids)", ids)
+    if params[PARAM_DATATYPE] == 'Plate':
+        return ("select distinct ws.image.id from WellSample ws "
+                "where ws.well.plate.id in (:ids) and ws.image.id > :last "
+                "order by ws.image.id",
+                "select count(distinct ws.image.id) from WellSample ws "
+                "where ws.well.plate.id in (:ids)", ids)
+    if params[PARAM_DATATYPE] == 'Screen':
+        return ("select distinct ws.image.id "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids) and ws.image.id > :last "
+                "order by ws.image.id",
+                "select count(distinct ws.image.id) "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids)", ids)
+    return ("select i.id from Image i where i.id in (:ids) "
+            "and i.id > :last order by i.id",
+            "select count(i.id) from Image i where i.id in (:ids)", ids)
+
+
+def count_images(conn, params):
+    """
+    Count the images defined in the script parameters
 
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    (query, count_query, ids) = image_query(params)
+    param = omero.sys.ParametersI()
+    if ids is not None:
+        param.addIds(ids)
+    rows = conn.getQueryService().projection(count_query, param,
+                                             conn.SERVICE_OPTS)
+    return rows and rows[0][0].val or 0
+
+
+def iter_image_ids(conn, params):
+    """
+    Generate the IDs of the images defined in the script parameters. The IDs
+    are paged from the server in ascending order by selecting the next page
+    above the last ID (keyset paging) so only one page is held in memory and
+    images deleted during a long run do not shift the later pages.
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    (query, count_query, ids) = image_query(params)
+    query_service = conn.getQueryService()
+    last = -1
+    while True:
+        param = omero.sys.ParametersI()
+        if ids is not None:
+            param.addIds(ids)
+        param.addLong('last', last)
+        param.page(0, BATCH_SIZE)
+        rows = query_service.projection(query, param, conn.SERVICE_OPTS)
+        for row in rows:
+            last = row[0].val
+            yield last
+        if len(rows) < BATCH_SIZE:
+            break
+
+
+def iter_images(conn, params):
+    """
+    Generate the ImageWrapper objects of the images defined in the script
+    parameters. The wrappers are loaded one page at a time.
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    for ids in batches(iter_image_ids(conn, params)):
+        images = dict([(x.getId(), x) for x in conn.getObjects('Image', ids)])
+        for image_id in ids:
+            if image_id in images:
+                yield images[image_id]
+
+
+def open_raw_pixels_store(conn, pixels_id):
+    """
+    Create a raw pixels store for the pixels. The caller must close the store.
 
-def process_image(conn, img, params):
+    @param conn:       The BlitzGateway connection
+    @param pixels_id:  The pixels ID
+    """
+    store = conn.c.sf.createRawPixelsStore()
+    store.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+    return store
+
+
+def iter_plane_hashes(conn, info, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Generate the ((z, c, t), sha1) hex digest of every plane of the image.
+    Each plane is streamed in strips of full-width rows so the digest is the
+    same as for the whole plane. The raw bytes from the server are passed
+    directly to the hash without conversion.
+
+    @param conn:       The BlitzGateway connection
+    @param info:       The ImageInfo of the image
+    @param tile_size:  The strip size is approximately tile_size^2 pixels
+    """
+    rows = max(1, tile_size * tile_size // info.x)
+    store = open_raw_pixels_store(conn, info.pixels_id)
+    try:
+        for z in range(info.z):
+            for c in range(info.c):
+                for t in range(info.t):
+                    sha1 = hashlib.sha1()
+                    for y in range(0, info.y, rows):
+                        sha1.update(store.getTile(
+                            z, c, t, 0, y, info.x, min(rows, info.y - y)))
+                    yield ((z, c, t), sha1.hexdigest())
+    finally:
+        store.close()
+
+
+def format_checksums(hashes):
+    """Format the plane checksums as text: one 'z c t sha1' line per plane"""
+    return "\n".join(["%d %d %d %s" % (zct + (h,)) for (zct, h) in hashes])
+
+
+def parse_checksums(text):
+    """Parse the plane checksums into a dictionary keyed by (z, c, t)"""
+    hashes = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 4:
+            hashes[tuple([int(v) for v in fields[:3]])] = fields[3]
+    return hashes
+
+
+def verify_checksums(conn, img, info, params):
+    """
+    Compute the checksum of every plane and compare with the checksums
+    stored in an annotation on the image. If the image has no stored
+    checksums they are recorded; the image fails if they cannot be saved.
+    Returns a tuple of (ok, message).
+
+    @param conn:   The BlitzGateway connection
+    @param img:    The ImageWrapper object
+    @param info:   The ImageInfo of the image
+    @param params: The script parameters
+    """
+    tile_size = max(1, params.get(PARAM_TILE_SIZE, DEFAULT_TILE_SIZE))
+    hashes = iter_plane_hashes(conn, info, tile_size)
+    ann = img.getAnnotation(CHECKSUM_NS)
+    if ann is None:
+        hashes = list(hashes)
+        ann = CommentAnnotationWrapper(conn,
+                                       omero.model.CommentAnnotationI())
+        ann.setNs(CHECKSUM_NS)
+        ann.setValue(format_checksums(hashes))
+        try:
+            ann.save()
+            img.linkAnnotation(ann)
+        except Exception, e:
+            # e.g. no permission to annotate the image
+            return (False, "Checksum %d plane%s not recorded : %s" % (
+                len(hashes), len(hashes) != 1 and 's' or '', e))
+        return (True, "Checksum %d plane%s recorded" % (
+            len(hashes), len(hashes) != 1 and 's' or ''))
+
+    stored = parse_checksums(ann.getValue())
+    count = 0
+    mismatch = 0
+    first = None
+    for (zct, h) in hashes:
+        count += 1
+        if stored.get(zct) != h:
+            mismatch += 1
+            if first is None:
+                first = zct
+    msg = "Checksum %d/%d plane%s match" % (
+        count - mismatch, count, count != 1 and 's' or '')
+    if first:
+        msg += " : first mismatch z%d,c%d,t%d" % tuple(
+            [i + 1 for i in first])
+    if len(stored) != count:
+        mismatch += 1
+        msg += " : %d stored" % len(stored)
+    return (not mismatch, msg)
+
+
+def check_image(conn, img, params, info=None, stats=None):
     """
     Extract the specified image and check the plane data.
+    Returns a tuple of (ok, message).
 
     @param conn:   The BlitzGateway connection
     @param img:    The ImageWrapper object
     @param params: The script parameters
+    @param info:   The prefetched ImageInfo (loaded if None)
+    @param stats:  The stored (min, max) of the last channel (can be None)
     """
-    (x, y, c, z, t) = (img.getSizeX(), img.getSizeY(), img.getSizeC(),
-                       img.getSizeZ(), img.getSizeT())
-    bytes = x * y * c * z * t * bytes_per_pixel(img.getPixelsType())
-    ds = img.getParent()
-    if ds:
-        pr = ds.getParent()
-    else:
-        pr = None
+    if info is None:
+        info = prefetch_images(conn, [img.getId()])[img.getId()]
+    (x, y, c, z, t) = (info.x, info.y, info.c, info.z, info.t)
 
     pixels = img.getPrimaryPixels()
 
-    # Check final plane
-    plane = pixels.getPlane(z-1, c-1, t-1)
+    known = stats_result(stats)
+    if params.get(PARAM_DEEP_SCAN):
+        # Check all planes
+        (ok, result) = deep_scan(pixels, (x, y, c, z, t), params)
+    elif known is not None:
+        # Decided by the stored statistics without reading pixels
+        ok = known
+        result = "stats min=%s,max=%s" % stats
+
+        if not ok and params.get(PARAM_LOCATE):
+            result += " : " + locate_truncation(pixels, (x, y, c, z, t),
+                                                info.dimension_order)
+    elif params.get(PARAM_TAIL_PROBE):
+        # Check the trailing rows of the final planes
+        (ok, result) = tail_probe(pixels, (x, y, c, z, t), params)
+    else:
+        # Check final plane
+        plane = pixels.getPlane(z-1, c-1, t-1)
+
+        stats = plane_stats(plane)
+        ok = stats[0] > 0
+        result = format_stats(stats)
+
+        if not ok and params.get(PARAM_LOCATE):
+            result += " : " + locate_truncation(pixels, (x, y, c, z, t),
+                                                info.dimension_order)
+
+    if params.get(PARAM_DUPLICATES):
+        (duplicates_ok, duplicates_result) = find_duplicates(
+            pixels, (x, y, c, z, t))
+        ok = ok and duplicates_ok
+        result += " : " + duplicates_result
 
-    ok = has_data(plane)
+    if params.get(PARAM_CHECKSUM):
+        (checksum_ok, checksum_result) = verify_checksums(conn, img, info,
+                                                          params)
+        ok = ok and checksum_ok
+        result += " : " + checksum_result
 
-    msg = "Image %d : %s : [%s][%s] %s : x%s,y%s,z%s,c%s,t%s : %s" % (
-        img.getId(),
+    return (ok, format_result(info, ok, result))
+
+
+def format_result(info, ok, result):
+    """
+    Build the report line for the image
+
+    @param info:   The ImageInfo of the image
+    @param ok:     True if the image passed the check
+    @param result: The description of the check result
+    """
+    (x, y, c, z, t) = (info.x, info.y, info.c, info.z, info.t)
+    bytes = x * y * c * z * t * bytes_per_pixel(info.pixels_type)
+    return "Image %d : %s : [%s][%s] %s : x%s,y%s,z%s,c%s,t%s : %s : %s" % (
+        info.id,
         ok and 'OK' or 'ERROR',
-        pr and pr.getName() or '-',
-        ds and ds.getName() or '-',
-        img.getName(),
+        info.project or info.screen or '-',
+        info.dataset or info.plate or '-',
+        info.name,
         x, y, z, c, t,
-        convert(bytes))
+        convert(bytes),
+        result)
+
+
+class VerificationCache(object):
+    """
+    On-disk cache of images that passed the check. Entries are keyed on the
+    image ID and store the pixels ID and the version of the pixels (update
+    event and checksum) so changed images are checked again. Each user has
+    their own cache file (see cache_file). The cache can be shared between
+    threads.
+    """
+
+    def __init__(self, filename):
+        filename = os.path.expanduser(filename)
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "create table if not exists images ("
+            "image_id integer primary key, pixels_id integer, "
+            "version text, message text)")
+        self._db.commit()
+        self._changes = 0
+
+    def get(self, image_id, key):
+        """
+        Return the cached report line if the image passed with the same key
+
+        @param image_id:  The image ID
+        @param key:       The (pixels id, version) of the image
+        """
+        with self._lock:
+            row = self._db.execute(
+                "select pixels_id, version, message from images "
+                "where image_id=?", (image_id,)).fetchone()
+        if row and (row[0], row[1]) == key:
+            return row[2]
+        return None
+
+    def put(self, image_id, key, ok, msg):
+        """
+        Record the result of an image check. Only images that passed are
+        stored.
+        """
+        with self._lock:
+            if ok:
+                self._db.execute(
+                    "insert or replace into images values (?, ?, ?, ?)",
+                    (image_id, key[0], key[1], msg))
+            else:
+                self._db.execute(
+                    "delete from images where image_id=?", (image_id,))
+            self._changes += 1
+            if self._changes % 100 == 0:
+                self._db.commit()
+
+    def evict_deleted(self, conn):
+        """
+        Remove entries for images that have been deleted from the server.
+        Only images with a delete event are evicted; images that are not
+        visible to the current session (e.g. after leaving a group) are kept.
+        Returns the number of evicted entries.
+
+        @param conn:   The BlitzGateway connection
+        """
+        with self._lock:
+            cached = [row[0] for row in self._db.execute(
+                "select image_id from images order by image_id")]
+        ctx = conn.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(-1)
+        query_service = conn.getQueryService()
+        deleted = []
+        for i in range(0, len(cached), BATCH_SIZE):
+            ids = cached[i:i + BATCH_SIZE]
+            param = omero.sys.ParametersI()
+            param.addIds(ids)
+            deleted.extend([row[0].val for row in query_service.projection(
+                "select distinct el.entityId from EventLog el "
+                "where el.entityType = 'ome.model.core.Image' "
+                "and el.action = 'DELETE' and el.entityId in (:ids)",
+                param, ctx)])
+        with self._lock:
+            self._db.executemany("delete from images where image_id=?",
+                                 [(x,) for x in deleted])
+            self._db.commit()
+        return len(deleted)
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def cache_file(conn):
+    """
+    Return the location of the verification cache of the current user
+
+    @param conn:   The BlitzGateway connection
+    """
+    return CACHE_FILE % conn.getUserId()
+
+
+def check_signature(params):
+    """
+    Return the description of the enabled checks that decide if an image
+    passes. A cached pass is only used by a run with the same checks.
+
+    @param params: The script parameters
+    """
+    checks = []
+    if params.get(PARAM_DEEP_SCAN):
+        checks.append("deep")
+    elif params.get(PARAM_TAIL_PROBE):
+        checks.append("tail%d" % (params.get(PARAM_TAIL_ROWS) or
+                                  DEFAULT_TAIL_ROWS))
+    else:
+        checks.append("last")
+    if params.get(PARAM_DUPLICATES):
+        checks.append("duplicates")
+    if params.get(PARAM_CHECKSUM):
+        checks.append("checksum")
+    return "+".join(checks)
+
+
+def image_key(img, params):
+    """
+    Return the (pixels id, version) of the image used to identify an
+    unchanged image in the verification cache. The version combines the
+    update event and the checksum of the pixels with the enabled checks.
+
+    @param img:    The ImageWrapper object
+    @param params: The script parameters
+    """
+    pixels = img._obj.getPrimaryPixels()
+    event = pixels.details.updateEvent
+    sha1 = pixels.getSha1()
+    return (pixels.id.val, "%s:%s:%s" % (event and event.id.val or 0,
+                                         sha1 and sha1.val or '',
+                                         check_signature(params)))
+
+
+def cached_result(img, params, cache):
+    """
+    Return the cached (ok, message) of the image, or None if the image must
+    be checked.
+
+    @param img:    The ImageWrapper object
+    @param params: The script parameters
+    @param cache:  The VerificationCache (can be None)
+    """
+    if cache is None or params.get(PARAM_RECHECK):
+        return None
+    msg = cache.get(img.getId(), image_key(img, params))
+    if msg:
+        return (True, msg + " : cached")
+    return None
+
+
+def process_image(conn, img, params, cache=None, info=None, stats=None):
+    """
+    Check the image and print the report line. Returns a tuple of
+    (ok, message).
+
+    @param conn:   The BlitzGateway connection
+    @param img:    The ImageWrapper object
+    @param params: The script parameters
+    @param cache:  The VerificationCache (can be None)
+    @param info:   The prefetched ImageInfo (loaded if None)
+    @param stats:  The stored (min, max) of the last channel (can be None)
+    """
+    result = cached_result(img, params, cache)
+    if result:
+        (ok, msg) = result
+    else:
+        (ok, msg) = check_image(conn, img, params, info, stats)
+        if cache:
+            cache.put(img.getId(), image_key(img, params), ok, msg)
 
     print msg
 
-    return ok
+    return (ok, msg)
+
+
+def add_to_plate(plates, info, ok):
+    """
+    Add the image result to the per-plate totals
+
+    @param plates: Dictionary of [name, count, ok] keyed by plate ID
+    @param info:   The ImageInfo of the image (can be None)
+    @param ok:     True if the image passed the check
+    """
+    if info is None or info.plate_id is None:
+        return
+    totals = plates.setdefault(info.plate_id, [info.plate, 0, 0])
+    totals[1] += 1
+    if ok:
+        totals[2] += 1
+
+
+def print_plates(plates):
+    """Print the per-plate totals"""
+    for plate_id in sorted(plates):
+        (name, count, ok) = plates[plate_id]
+        print "Plate %d : %s : %s" % (plate_id, name, summary(count, ok))
+
+
+def prefetch_archives(conn, infos):
+    """
+    Load the original files of the archived images using one query per batch
+    of pixels IDs. Returns a dictionary of lists of (file ID, size) keyed by
+    pixels ID. The files are in ascending ID order so the last file that
+    identifies the archive is the same for every image of a fileset.
+
+    @param conn:   The BlitzGateway connection
+    @param infos:  The ImageInfo of the images
+    """
+    files = {}
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    query_service = conn.getQueryService()
+    for ids in batches([x.pixels_id for x in infos if x.archived]):
+        param = omero.sys.ParametersI()
+        param.addIds(ids)
+        for row in query_service.projection(
+                "select m.child.id, f.id, f.size "
+                "from PixelsOriginalFileMap m join m.parent f "
+                "where m.child.id in (:ids) order by m.child.id, f.id",
+                param, ctx):
+            (pixels_id, file_id, size) = [unwrap(v) for v in row]
+            files.setdefault(pixels_id, []).append((file_id, size or 0))
+    return files
+
+
+def csv_text(value):
+    """Return the value as a UTF-8 string for the CSV writer"""
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class IdSet(object):
+    """
+    Set of non-negative integer IDs stored as a bitmap. Database IDs are
+    dense so this uses one bit per ID up to the largest ID added, much less
+    than a dictionary entry per ID.
+    """
+
+    def __init__(self):
+        self._bits = bytearray()
+
+    def add(self, id):
+        """
+        Add the ID to the set. Returns True if the ID was not in the set.
+
+        @param id:     The ID
+        """
+        (index, mask) = (id >> 3, 1 << (id & 7))
+        if index >= len(self._bits):
+            # Grow by doubling to amortise the copy
+            self._bits.extend(bytearray(
+                max(index + 1, 2 * len(self._bits)) - len(self._bits)))
+        elif self._bits[index] & mask:
+            return False
+        self._bits[index] |= mask
+        return True
+
+    def __contains__(self, id):
+        index = id >> 3
+        return (index < len(self._bits) and
+                bool(self._bits[index] & (1 << (id & 7))))
+
+
+def count_archive(counted, file_id, archive_bytes):
+    """
+    Return the archived bytes to add to the total. Original files can contain
+    multiple images so only count archived bytes in total once.
+
+    @param counted:        The IdSet of original file IDs already counted
+    @param file_id:        The original file ID (can be None)
+    @param archive_bytes:  The archived bytes of the image
+    """
+    if file_id is None or counted.add(file_id):
+        return archive_bytes
+    return 0
+
+
+class ImageAudit(object):
+    """
+    Combined size and data check report of the images written to a
+    temporary CSV file and uploaded as a file annotation. Images are added
+    in report order using the ImageInfo already loaded for the check. The
+    archived files are loaded for each batch of images so no further image
+    lookups are required. Archived bytes are counted once per original file
+    in the totals.
+    """
+
+    COLUMNS = ['Image', 'Name', 'Project', 'Dataset', 'Screen', 'Plate',
+               'X', 'Y', 'Z', 'C', 'T', 'Type', 'Bytes', 'Archive ID',
+               'Archived Bytes', 'OK', 'Report']
+
+    def __init__(self, conn):
+        self._conn = conn
+        (fd, self.filename) = tempfile.mkstemp(suffix='.csv')
+        self._file = os.fdopen(fd, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.COLUMNS)
+        self._pending = []
+        self._counted = IdSet()
+        self.count = 0
+        self.total = 0L
+        self.total_archived = 0L
+
+    def add(self, info, ok, msg):
+        """
+        Add the image to the report
+
+        @param info:   The ImageInfo of the image (can be None)
+        @param ok:     True if the image passed the check
+        @param msg:    The report line of the check
+        """
+        if info is None:
+            return
+        self._pending.append((info, ok, msg))
+        if len(self._pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the pending images"""
+        files = prefetch_archives(self._conn,
+                                  [x[0] for x in self._pending])
+        for (info, ok, msg) in self._pending:
+            (x, y, c, z, t) = (info.x, info.y, info.c, info.z, info.t)
+            bytes = x * y * c * z * t * bytes_per_pixel(info.pixels_type)
+            archive_bytes = 0
+            file_id = None
+            for (file_id, size) in files.get(info.pixels_id, []):
+                archive_bytes += size
+            self.count += 1
+            self.total += bytes
+            self.total_archived += count_archive(self._counted, file_id,
+                                                 archive_bytes)
+            self._writer.writerow([csv_text(v) for v in [
+                info.id, info.name, info.project, info.dataset, info.screen,
+                info.plate, x, y, z, c, t, info.pixels_type, bytes, file_id,
+                archive_bytes, ok and 'OK' or 'ERROR', msg]])
+        self._pending = []
+
+    def close(self):
+        """Write the pending images and close the file"""
+        self.flush()
+        self._file.close()
+
+    def print_report(self):
+        """
+        Print the size line of each audited image, read back from the
+        closed report, and the totals
+        """
+        with open(self.filename, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                (image_id, name, project, dataset, screen, plate) = row[:6]
+                (bytes, file_id, archive_bytes) = row[12:15]
+                msg = "Audit : Image %s : [%s][%s] %s : %s" % (
+                    image_id, project or screen or '-',
+                    dataset or plate or '-', name, convert(long(bytes)))
+                if file_id:
+                    msg += " : Archive ID [%s] %s" % (
+                        file_id, convert(long(archive_bytes)))
+                print msg
+        print "Audit : %d image%s : Raw pixels %s : Archived %s" % (
+            self.count, self.count != 1 and 's' or '',
+            convert(self.total), convert(self.total_archived))
+
+    def discard(self):
+        """Close and remove the report without writing the pending images"""
+        self._file.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def upload(self):
+        """
+        Upload the closed report as a file annotation and remove the
+        temporary file. Returns the FileAnnotationWrapper.
+        """
+        try:
+            return self._conn.createFileAnnfromLocalFile(
+                self.filename, origFilePathAndName=AUDIT_FILE_NAME,
+                mimetype='text/csv', ns=AUDIT_NS)
+        finally:
+            os.remove(self.filename)
+
+
+def create_worker_connection(conn):
+    """
+    Create a new BlitzGateway connection joined to the session of the given
+    connection.
+
+    @param conn:   The BlitzGateway connection
+    """
+    client = conn.c.createClient(secure=True)
+    return BlitzGateway(client_obj=client)
+
+
+def run_parallel(conn, images, params, cache=None, plates=None,
+                 audit=None):
+    """
+    Check the images using a pool of worker threads, each with its own
+    BlitzGateway connection. Report lines are printed in the order of the
+    input images. Returns a tuple of (count, ok).
+
+    @param conn:   The BlitzGateway connection
+    @param images: The ImageWrapper objects
+    @param params: The script parameters
+    @param cache:  The VerificationCache (can be None)
+    @param plates: Dictionary of per-plate totals to update (can be None)
+    @param audit:  The ImageAudit to update (can be None)
+    """
+    n = params[PARAM_WORKERS]
+    tasks = Queue.Queue(n * 4)
+    results = Queue.Queue()
+
+    # Exception raised by the producer (re-raised in the main thread)
+    errors = []
+
+    def produce():
+        index = 0
+        try:
+            for batch in batches(images):
+                infos = prefetch_images(conn, [x.getId() for x in batch])
+                stats = prefetch_stats(conn, infos.values(), params)
+                for img in batch:
+                    info = infos.get(img.getId())
+                    result = cached_result(img, params, cache)
+                    if result:
+                        results.put((index,) + result + (info,))
+                    else:
+                        tasks.put((index, img.getId(), info,
+                                   info and stats.get(info.pixels_id)))
+                    index += 1
+        except Exception, e:
+            errors.append(e)
+        finally:
+            # Always end the work so the workers and main thread finish
+            for i in range(n):
+                tasks.put(None)
+            results.put((index, None, None, None))
+
+    def work(worker_conn):
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                (index, image_id, info, stats) = task
+                try:
+                    img = worker_conn.getObject('Image', image_id)
+                    (ok, msg) = check_image(worker_conn, img, params, info,
+                                            stats)
+                    if cache:
+                        cache.put(image_id, image_key(img, params), ok, msg)
+                except Exception, e:
+                    (ok, msg) = (False, "Image %d : ERROR : %s" % (
+                        image_id, e))
+                results.put((index, ok, msg, info))
+        finally:
+            worker_conn.c.closeSession()
+
+    threads = [threading.Thread(target=produce)]
+    for i in range(n):
+        threads.append(threading.Thread(
+            target=work, args=(create_worker_connection(conn),)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Re-order the results to match the input order
+    count = 0
+    ok = 0L
+    total = None
+    pending = {}
+    while total is None or count < total:
+        (index, result, msg, info) = results.get()
+        if msg is None:
+            total = index
+            continue
+        pending[index] = (result, msg, info)
+        while count in pending:
+            (result, msg, info) = pending.pop(count)
+            print msg
+            count += 1
+            if result:
+                ok += 1
+            if plates is not None:
+                add_to_plate(plates, info, result)
+            if audit:
+                audit.add(info, result, msg)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return (count, ok)
+
+
+def use_pipeline(params):
+    """Return True if the final plane check can use the pipelined reads"""
+    return (params.get(PARAM_PIPELINE, 0) > 0 and
+            not (params.get(PARAM_DEEP_SCAN) or
+                 params.get(PARAM_TAIL_PROBE) or
+                 params.get(PARAM_DUPLICATES) or
+                 params.get(PARAM_CHECKSUM)))
+
+
+def run_pipelined(conn, images, params, cache=None, plates=None,
+                  audit=None):
+    """
+    Check the final plane of the images keeping multiple plane requests in
+    flight using asynchronous (AMI) calls to the raw pixels store. Planes
+    are validated while the following requests are transferred. Report
+    lines are printed in the order of the input images. Returns a tuple of
+    (count, ok).
+
+    @param conn:   The BlitzGateway connection
+    @param images: The ImageWrapper objects
+    @param params: The script parameters
+    @param cache:  The VerificationCache (can be None)
+    @param plates: Dictionary of per-plate totals to update (can be None)
+    @param audit:  The ImageAudit to update (can be None)
+    """
+    depth = params[PARAM_PIPELINE]
+    start_time = time.time()
+    # Sum of the time each plane request was in flight
+    busy = [0.0]
+    reads = [0]
+
+    def generate():
+        """Generate the (img, info, stats) of each image"""
+        for batch in batches(images):
+            infos = prefetch_images(conn, [x.getId() for x in batch])
+            stats = prefetch_stats(conn, infos.values(), params)
+            for img in batch:
+                info = infos.get(img.getId())
+                yield (img, info, info and stats.get(info.pixels_id))
+
+    # The stages of the asynchronous read: create the store, set the
+    # pixels ID and read the plane
+    (CREATE, SET_PIXELS, GET_PLANE) = range(3)
+
+    def start(entry):
+        """Start the asynchronous read of the final plane"""
+        entry['start'] = time.time()
+        entry['async'] = conn.c.sf.begin_createRawPixelsStore(
+            _ctx=conn.SERVICE_OPTS)
+
+    def advance(entry):
+        """Complete the current stage of the read and start the next"""
+        info = entry['info']
+        if entry['stage'] == CREATE:
+            store = conn.c.sf.end_createRawPixelsStore(entry['async'])
+            entry['store'] = store
+            entry['async'] = store.begin_setPixelsId(
+                info.pixels_id, True, _ctx=conn.SERVICE_OPTS)
+        else:
+            entry['store'].end_setPixelsId(entry['async'])
+            entry['async'] = entry['store'].begin_getPlane(
+                info.z - 1, info.c - 1, info.t - 1, _ctx=conn.SERVICE_OPTS)
+        entry['stage'] += 1
+
+    def finish(entry):
+        """Validate the plane and return (ok, message)"""
+        (img, info, store) = (entry['img'], entry['info'], entry['store'])
+        raw = store.end_getPlane(entry['async'])
+        busy[0] += time.time() - entry['start']
+        reads[0] += 1
+        store.begin_close()
+        dtype = numpy.dtype(PIXEL_DTYPES[info.pixels_type])
+        plane = numpy.fromstring(raw, dtype=dtype.newbyteorder('>'))
+        plane = plane.reshape(info.y, info.x)
+        stats = plane_stats(plane)
+        ok = stats[0] > 0
+        result = format_stats(stats)
+        if not ok and params.get(PARAM_LOCATE):
+            result += " : " + locate_truncation(
+                img.getPrimaryPixels(),
+                (info.x, info.y, info.c, info.z, info.t),
+                info.dimension_order)
+        return (ok, format_result(info, ok, result))
+
+    count = 0
+    ok = 0L
+    pending = collections.deque()
+    source = generate()
+    more = True
+    while more or pending:
+        # Fill the pipeline. Images that need no plane read are queued
+        # with their result.
+        while more and len(pending) < depth:
+            try:
+                (img, info, stats) = source.next()
+            except StopIteration:
+                more = False
+                break
+            entry = {'img': img, 'info': info, 'stage': CREATE,
+                     'result': None}
+            entry['result'] = cached_result(img, params, cache)
+            if entry['result'] is None and (
+                    info is None or stats_result(stats) is not None):
+                entry['result'] = check_image(conn, img, params, info, stats)
+                if cache:
+                    cache.put(img.getId(), image_key(img, params),
+                              *entry['result'])
+            if entry['result'] is None:
+                start(entry)
+            pending.append(entry)
+
+        if not pending:
+            break
+
+        # Advance the reads with a completed stage
+        for entry in pending:
+            while (entry['result'] is None and
+                   entry['stage'] != GET_PLANE and
+                   entry['async'].isCompleted()):
+                advance(entry)
+
+        # Complete the oldest image
+        entry = pending.popleft()
+        if entry['result'] is None:
+            while entry['stage'] != GET_PLANE:
+                advance(entry)
+            entry['result'] = finish(entry)
+            if cache:
+                cache.put(entry['img'].getId(),
+                          image_key(entry['img'], params), *entry['result'])
+        (result, msg) = entry['result']
+        print msg
+        count += 1
+        if result:
+            ok += 1
+        if plates is not None:
+            add_to_plate(plates, entry['info'], result)
+        if audit:
+            audit.add(entry['info'], result, msg)
+
+    elapsed = time.time() - start_time
+    if reads[0]:
+        print "Pipeline depth %d : %d plane%s in %.2f sec : overlap %.2f" % (
+            depth, reads[0], reads[0] != 1 and 's' or '', elapsed,
+            elapsed > 0 and busy[0] / elapsed or 0)
+
+    return (count, ok)
 
 
 def run(conn, params):
     """
     For each image defined in the script parameters calculate the raw byte size
 
+    Returns a tuple of (count, ok, annotation) where annotation is the
+    uploaded audit report (None if not audited).
+
     @param conn:   The BlitzGateway connection
     @param params: The script parameters
     """
@@ -170,39 +1543,78 @@ def run(conn, params):
 
     # print "Parameters = %s" % params
 
-    images = []
-    if params[PARAM_ALL_IMAGES]:
-        images = list(conn.getObjects('Image'))
-    else:
-        objects = conn.getObjects(params[PARAM_DATATYPE],
-                                  params.get(PARAM_IDS, [0]))
-        if params[PARAM_DATATYPE] == 'Dataset':
-            for ds in objects:
-                images.extend(list(ds.listChildren()))
-        else:
-            images = list(objects)
-
-        # Remove duplicate images in multiple datasets
-        seen = set()
-        images = [x for x in images if x.id not in seen and not seen.add(x.id)]
+    total = count_images(conn, params)
+    images = iter_images(conn, params)
 
     print("Processing %s image%s" % (
-        len(images), len(images) != 1 and 's' or ''))
+        total, total != 1 and 's' or ''))
 
     print "-=-=-=-"
 
+    cache = None
+    if params.get(PARAM_CACHE):
+        cache = VerificationCache(cache_file(conn))
+
+    audit = None
+    if params.get(PARAM_AUDIT):
+        audit = ImageAudit(conn)
+    annotation = None
+
     count = 0
     ok = 0L
-    for img in images:
-        if (img is not None):
-            count = count + 1
-            if process_image(conn, img, params):
-                ok = ok + 1
+    plates = {}
+    try:
+        if params.get(PARAM_WORKERS, 1) > 1:
+            (count, ok) = run_parallel(conn, images, params, cache, plates,
+                                       audit)
+        elif use_pipeline(params):
+            (count, ok) = run_pipelined(conn, images, params, cache, plates,
+                                        audit)
+        else:
+            for batch in batches(images):
+                infos = prefetch_images(conn, [x.getId() for x in batch])
+                stats = prefetch_stats(conn, infos.values(), params)
+                for img in batch:
+                    count = count + 1
+                    info = infos.get(img.getId())
+                    (result, msg) = process_image(
+                        conn, img, params, cache, info,
+                        info and stats.get(info.pixels_id))
+                    if result:
+                        ok = ok + 1
+                    add_to_plate(plates, info, result)
+                    if audit:
+                        audit.add(info, result, msg)
+
+        if count:
+            print "-=-=-=-"
 
-    if count:
-        print "-=-=-=-"
+        if plates:
+            print_plates(plates)
+            print "-=-=-=-"
 
-    return (count, ok)
+        if audit:
+            audit.close()
+            audit.print_report()
+            # upload removes the file so the failed run cleanup is skipped
+            (upload, audit) = (audit, None)
+            annotation = upload.upload()
+            print "Audit : File annotation %d" % annotation.getId()
+            print "-=-=-=-"
+
+        if cache:
+            evicted = cache.evict_deleted(conn)
+            if evicted:
+                print "Evicted %d deleted image%s from the cache" % (
+                    evicted, evicted != 1 and 's' or '')
+    finally:
+        if cache:
+            cache.close()
+        if audit:
+            # Failed run: discard the partial report
+            audit.discard()
+
+    return (count, ok, annotation)
 
 
 def summary(count, ok):
@@ -214,6 +1626,123 @@ def summary(count, ok):
     return msg
 
 
+###############################################################################
+# Offline benchmark of the plane scanning using synthetic pixel data
+
+# Plane edge lengths used by the benchmark
+BENCHMARK_SIZES = [512, 1024, 2048, 4096, 8192, 16384]
+
+# Default maximum plane edge length of the benchmark. Larger planes need
+# several GB of memory and must be requested explicitly.
+DEFAULT_BENCHMARK_MAX = 4096
+
+# Minimum time spent timing each benchmark case (seconds)
+BENCHMARK_TIME = 0.5
+
+
+class SyntheticPixels(object):
+    """
+    In-memory replacement for the PixelsWrapper holding a single plane
+    """
+
+    def __init__(self, plane):
+        self.plane = plane
+
+    def getPlane(self, z, c, t):
+        return self.plane
+
+    def getTiles(self, zctTileList):
+        for (z, c, t, (x, y, w, h)) in zctTileList:
+            yield self.plane[y:y + h, x:x + w]
+
+
+class SyntheticImage(object):
+    """
+    In-memory replacement for the ImageWrapper with a single plane
+    """
+
+    def __init__(self, plane):
+        self.pixels = SyntheticPixels(plane)
+
+    def getPrimaryPixels(self):
+        return self.pixels
+
+
+def synthetic_plane(pixel_type, size, pattern):
+    """
+    Create a square plane of pixel data
+
+    @param pixel_type:  The OMERO pixel type
+    @param size:        The plane edge length
+    @param pattern:     'blank' (all zero), 'data' (all non-zero) or 'late'
+                        (zero except the final pixel)
+    """
+    if pattern == 'data':
+        plane = numpy.ones((size, size), dtype=PIXEL_DTYPES[pixel_type])
+    else:
+        plane = numpy.zeros((size, size), dtype=PIXEL_DTYPES[pixel_type])
+        if pattern == 'late':
+            plane[-1, -1] = 1
+    return plane
+
+
+def time_function(function):
+    """
+    Call the function repeatedly for at least BENCHMARK_TIME seconds.
+    Returns the calls per second.
+    """
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < BENCHMARK_TIME:
+        function()
+        count += 1
+        elapsed = time.time() - start
+    return count / elapsed
+
+
+def run_benchmark(max_size=None):
+    """
+    Benchmark the plane scanning throughput using synthetic planes of each
+    pixel type, size and data pattern. Requires no OMERO server.
+
+    @param max_size:  The maximum plane edge length
+                      (default is DEFAULT_BENCHMARK_MAX)
+    """
+    max_size = max_size or DEFAULT_BENCHMARK_MAX
+    global convert
+    convert = convert_raw
+    params = {PARAM_TILE_SIZE: DEFAULT_TILE_SIZE}
+    pixel_types = sorted(PIXEL_DTYPES.keys(), key=bytes_per_pixel)
+    print "%-6s %6s %-5s %-12s %12s %10s" % (
+        'Type', 'Size', 'Data', 'Method', 'Planes/sec', 'MB/sec')
+    for size in BENCHMARK_SIZES:
+        if size > max_size:
+            break
+        for pixel_type in pixel_types:
+            for pattern in ['blank', 'data', 'late']:
+                plane = synthetic_plane(pixel_type, size, pattern)
+                img = SyntheticImage(plane)
+                info = ImageInfo(0, 'synthetic', 0, size, size, 1, 1, 1,
+                                 pixel_type, None, None, None, None, None,
+                                 False, 'XYZCT')
+                deep_params = dict(params)
+                deep_params[PARAM_DEEP_SCAN] = True
+                methods = [
+                    ('has_data', lambda: has_data(plane)),
+                    ('plane_stats', lambda: plane_stats(plane)),
+                    ('check_image',
+                     lambda: check_image(None, img, params, info)),
+                    ('deep_scan',
+                     lambda: check_image(None, img, deep_params, info)),
+                ]
+                mb = plane.nbytes / 1048576.0
+                for (name, function) in methods:
+                    rate = time_function(function)
+                    print "%-6s %6d %-5s %-12s %12.2f %10.1f" % (
+                        pixel_type, size, pattern, name, rate, rate * mb)
+
+
 def run_as_program():
     """
     Testing function to allow the script to be called outside of the OMERO
@@ -239,8 +1768,22 @@ def run_as_program():
     params[PARAM_DATATYPE] = "Image"
     params[PARAM_ALL_IMAGES] = True
     params[PARAM_READABLE] = True
-
-    (count, ok) = run(conn, params)
+    params[PARAM_STATS] = True
+    params[PARAM_TAIL_PROBE] = False
+    params[PARAM_TAIL_ROWS] = DEFAULT_TAIL_ROWS
+    params[PARAM_LOCATE] = True
+    params[PARAM_DUPLICATES] = False
+    params[PARAM_PIPELINE] = 0
+    params[PARAM_DEEP_SCAN] = False
+    params[PARAM_TILE_SIZE] = DEFAULT_TILE_SIZE
+    params[PARAM_MAX_FAILURES] = 1
+    params[PARAM_CHECKSUM] = False
+    params[PARAM_WORKERS] = 4
+    params[PARAM_CACHE] = True
+    params[PARAM_RECHECK] = False
+    params[PARAM_AUDIT] = False
+
+    (count, ok, annotation) = run(conn, params)
 
     print (summary(count, ok))
 
@@ -250,12 +1793,50 @@ def run_as_script():
     The main entry point of the script, as called by the client via the
     scripting service, passing the required parameters.
     """
-    dataTypes = [rstring('Dataset'), rstring('Image')]
+    dataTypes = [rstring('Dataset'), rstring('Image'), rstring('Plate'),
+                 rstring('Screen')]
 
     client = scripts.client('Check_Images.py', """\
 Verify the image contains data.
 
 The last frame in the image is checked for pixel data to ensure complete import.
+The report includes the non-zero pixel count, min/max and the percentage of
+rows in the frame that contain only zeros.
+
+Optionally the stored channel statistics (global min/max) are used to decide
+without reading pixels: a channel minimum above zero proves the final plane
+has data. Pixels are read when the statistics are missing or ambiguous.
+
+Optionally a tail probe reads only the bottom rows of the final plane of each
+channel. This detects partially written planes where the trailing rows are
+blank.
+
+Optionally the last plane with data in a truncated image can be located using
+a binary search over the planes in the order they are stored (the dimension
+order of the pixels).
+
+Optionally a deep scan streams every Z/C/T plane in tiles and reports the
+first blank plane.
+
+Optionally runs of identical consecutive planes in each channel are reported.
+Broken imports can repeat the last good plane instead of writing zeros.
+
+Optionally the SHA-1 checksum of every plane can be verified against the
+checksums stored in an annotation on the image. If missing they are recorded.
+
+Images can be checked in parallel using multiple sessions.
+
+Plates and Screens report the totals per plate.
+
+Optionally the final plane reads of consecutive images are pipelined using
+asynchronous calls so the transfer is not limited by the round-trip latency.
+
+Optionally a verification cache on the server records the images each user
+has seen pass so unchanged images are not checked again.
+
+Optionally an audit reports the raw and archived size of each image and
+attaches a CSV file of the sizes with the check result, replacing a separate
+run of Image_Size over the same images.
 
 Warning:
 
@@ -270,7 +1851,8 @@ See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/checkimages"
         default="Image"),
 
     scripts.List(PARAM_IDS, optional=True, grouping="1.2",
-        description="List of Dataset IDs or Image IDs").ofType(rlong(0)),
+        description="List of Dataset, Image, Plate or Screen IDs"
+        ).ofType(rlong(0)),
 
     scripts.Bool(PARAM_ALL_IMAGES, grouping="1.3",
         description="Process all images (ignore the ID parameters)",
@@ -280,6 +1862,72 @@ See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/checkimages"
         description="Show human-readable bytes",
         default=True),
 
+    scripts.Bool(PARAM_DEEP_SCAN, grouping="3",
+        description="Check every Z/C/T plane by streaming tiles "
+                    "(slow)",
+        default=False),
+
+    scripts.Int(PARAM_TILE_SIZE, grouping="3.1",
+        description="Tile edge length used to stream the planes",
+        default=DEFAULT_TILE_SIZE, min=16),
+
+    scripts.Int(PARAM_MAX_FAILURES, grouping="3.2",
+        description="Stop scanning an image after this many blank planes "
+                    "(0 for no limit)",
+        default=1, min=0),
+
+    scripts.Bool(PARAM_LOCATE, grouping="4",
+        description="Locate the last plane with data when the final plane "
+                    "is blank",
+        default=False),
+
+    scripts.Bool(PARAM_CHECKSUM, grouping="5",
+        description="Verify every plane against the stored checksums "
+                    "(records the checksums if missing)",
+        default=False),
+
+    scripts.Int(PARAM_WORKERS, grouping="6",
+        description="Number of parallel sessions used to check the images",
+        default=1, min=1, max=32),
+
+    scripts.Bool(PARAM_CACHE, grouping="7",
+        description="Skip unchanged images that passed a previous check",
+        default=False),
+
+    scripts.Bool(PARAM_RECHECK, grouping="7.1",
+        description="Check all images and refresh the cache",
+        default=False),
+
+    scripts.Bool(PARAM_STATS, grouping="8",
+        description="Use the stored channel statistics to decide if the "
+                    "final plane has data without reading pixels",
+        default=False),
+
+    scripts.Bool(PARAM_TAIL_PROBE, grouping="9",
+        description="Check only the bottom rows of the final plane of each "
+                    "channel to detect partially written planes",
+        default=False),
+
+    scripts.Int(PARAM_TAIL_ROWS, grouping="9.1",
+        description="Number of rows read from the bottom of the plane",
+        default=DEFAULT_TAIL_ROWS, min=1),
+
+    scripts.Bool(PARAM_DUPLICATES, grouping="10",
+        description="Report runs of identical consecutive planes in each "
+                    "channel (reads all planes)",
+        default=False),
+
+    scripts.Int(PARAM_PIPELINE, grouping="11",
+        description="Number of final plane reads kept in flight using "
+                    "asynchronous calls (0 to disable). Used when only "
+                    "the final plane is checked by one session",
+        default=0, min=0, max=64),
+
+    scripts.Bool(PARAM_AUDIT, grouping="12",
+        description="Report the size of each image and attach a combined "
+                    "size and check report as a CSV file",
+        default=False),
+
     version="1.0",
     authors=["Alex Herbert", "GDSC"],
     institutions=["University of Sussex"],
@@ -296,7 +1944,10 @@ See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/checkimages"
                 params[key] = client.getInput(key, unwrap=True)
 
         # Call the main script - returns the number of images and total bytes
-        (count, ok) = run(conn, params)
+        (count, ok, annotation) = run(conn, params)
+
+        if annotation:
+            client.setOutput("File_Annotation", robject(annotation._obj))
 
         if count >= 0:
             print "Images : %s" % count
@@ -318,8 +1969,12 @@ if __name__ == "__main__":
     function_to_run = run_as_script
 
     # Allow the script to be run on the command-line by passing the param 'run'
-    for arg in sys.argv:
+    # or 'benchmark [max size]'
+    for i, arg in enumerate(sys.argv):
         if arg == 'run':
             function_to_run = run_as_program
+        elif arg == 'benchmark':
+            max_size = len(sys.argv) > i + 1 and int(sys.argv[i + 1]) or None
+            function_to_run = functools.partial(run_benchmark, max_size)
 
     function_to_run()
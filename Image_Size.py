@@ -4,8 +4,14 @@
 This produces a report of the raw byte size for each selected image.
 """
 
+import os
 import sys
 import locale
+import sqlite3
+import threading
+import Queue
+import heapq
+import collections
 try:
     locale.setlocale(locale.LC_ALL, 'en_GB')
 except:
@@ -21,9 +27,67 @@ PARAM_IDS = "IDs"
 PARAM_ALL_IMAGES = "All_Images"
 PARAM_READABLE = "Readable_Bytes"
 PARAM_ARCHIVED = "Include_Archived"
-
-# Global dictionary of original file IDs
-original_ids = {}
+PARAM_WORKERS = "Workers"
+PARAM_SERVER_TOTALS = "Server_Totals"
+PARAM_GROUP_BY = "Group_By"
+PARAM_PER_IMAGE = "Per_Image"
+PARAM_ROLLUPS = "Rollups"
+PARAM_SNAPSHOT = "Use_Snapshot"
+PARAM_REBUILD = "Full_Rebuild"
+PARAM_TOP_N = "Top_N"
+PARAM_DUPLICATES = "Duplicate_Archives"
+
+# Location of the incremental size snapshots of each user (keyed by user ID)
+SNAPSHOT_FILE = "~/.omero/image_size_%d.db"
+
+# Number of IDs used in each query of an 'in' clause
+BATCH_SIZE = 500
+
+# The image details used to build the report
+ImageInfo = collections.namedtuple(
+    'ImageInfo',
+    'id name pixels_id x y z c t pixels_type dataset project '
+    'plate_id plate screen archived dataset_id project_id owner group')
+
+PREFETCH_QUERY = (
+    "select i.id, i.name, p.id, p.sizeX, p.sizeY, p.sizeZ, p.sizeC, "
+    "p.sizeT, pt.value, ds.name, pr.name, plate.id, plate.name, sc.name, "
+    "i.archived, ds.id, pr.id, o.omeName, g.name "
+    "from Image i join i.details.owner o join i.details.group g "
+    "join i.pixels p join p.pixelsType pt "
+    "left outer join i.datasetLinks dl left outer join dl.parent ds "
+    "left outer join ds.projectLinks pl left outer join pl.parent pr "
+    "left outer join i.wellSamples ws left outer join ws.well w "
+    "left outer join w.plate plate "
+    "left outer join plate.screenLinks sl left outer join sl.parent sc "
+    "where i.id in (:ids) order by i.id, ds.id, pr.id")
+
+# Conditions that keep only the first dataset of an image, and the first
+# project of that dataset, matching the per-image report (see
+# PREFETCH_QUERY) so images are not counted once per link
+FIRST_DATASET = (
+    "(ds.id is null or ds.id = (select min(l2.parent.id) "
+    "from DatasetImageLink l2 where l2.child.id = i.id))")
+FIRST_PROJECT = (
+    "(pr.id is null or pr.id = (select min(l3.parent.id) "
+    "from ProjectDatasetLink l3 where l3.child.id = ds.id))")
+
+# The (columns, joins, condition) used to group the server totals. The
+# columns are the ID and name of the group.
+GROUP_BY = {
+    'None': (None, "", None),
+    'Owner': ("o.id, o.omeName", "join i.details.owner o ", None),
+    'Group': ("g.id, g.name", "join i.details.group g ", None),
+    'Dataset': ("ds.id, ds.name",
+                "left outer join i.datasetLinks dl "
+                "left outer join dl.parent ds ", FIRST_DATASET),
+    'Project': ("pr.id, pr.name",
+                "left outer join i.datasetLinks dl "
+                "left outer join dl.parent ds "
+                "left outer join ds.projectLinks pl "
+                "left outer join pl.parent pr ",
+                FIRST_DATASET + " and " + FIRST_PROJECT),
+}
 
 
 def bytes_per_pixel(pixel_type):
@@ -112,62 +176,1117 @@ def convert_raw(number, verbosity=100):
                           number != 1 and 's' or '')
 
 
-def process_image(conn, img, params):
+def batches(items, size=BATCH_SIZE):
+    """
+    Split the items into lists of the given size
+
+    @param items:  The items (any iterable)
+    @param size:   The maximum batch size
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetch_images(conn, image_ids):
+    """
+    Load the name, pixel dimensions, pixel type, dataset and project names and
+    archived flag of the images using one projection query per batch of IDs.
+    If an image is in multiple datasets the dataset with the lowest ID is used
+    (as in the grouped server totals). Returns a dictionary of ImageInfo
+    keyed by image ID.
+
+    @param conn:       The BlitzGateway connection
+    @param image_ids:  The image IDs
+    """
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    query_service = conn.getQueryService()
+    infos = {}
+    for ids in batches(image_ids):
+        param = omero.sys.ParametersI()
+        param.addIds(ids)
+        for row in query_service.projection(PREFETCH_QUERY, param, ctx):
+            info = ImageInfo(*[unwrap(v) for v in row])
+            if info.id not in infos:
+                infos[info.id] = info
+    return infos
+
+
+def image_query(params):
+    """
+    Return the HQL queries selecting the IDs of the images defined in the
+    script parameters. Returns a tuple of (query, count_query, ids) where the
+    query selects the distinct image IDs above the :last parameter in
+    ascending order (for keyset paging) and ids is the value for the :ids
+    parameter (None if not used).
+
+    @param params: The script parameters
+    """
+    if params.get(PARAM_ALL_IMAGES):
+        return ("select i.id from Image i where i.id > :last order by i.id",
+                "select count(i.id) from Image i", None)
+    ids = params.get(PARAM_IDS, [0])
+    if params[PARAM_DATATYPE] == 'Dataset':
+        return ("select distinct l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids) and l.child.id > :last "
+                "order by l.child.id",
+                "select count(distinct l.child.id) from DatasetImageLink l "
+                "where l.parent.id in (:ids)", ids)
+    if params[PARAM_DATATYPE] == 'Plate':
+        return ("select distinct ws.image.id from WellSample ws "
+                "where ws.well.plate.id in (:ids) and ws.image.id > :last "
+                "order by ws.image.id",
+                "select count(distinct ws.image.id) from WellSample ws "
+                "where ws.well.plate.id in (:ids)", ids)
+    if params[PARAM_DATATYPE] == 'Screen':
+        return ("select distinct ws.image.id "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids) and ws.image.id > :last "
+                "order by ws.image.id",
+                "select count(distinct ws.image.id) "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids)", ids)
+    return ("select i.id from Image i where i.id in (:ids) "
+            "and i.id > :last order by i.id",
+            "select count(i.id) from Image i where i.id in (:ids)", ids)
+
+
+def image_filter(params):
+    """
+    Return the HQL condition on Image i that selects the images defined in
+    the script parameters. Returns a tuple of (condition, ids) where ids is
+    the value for the :ids parameter. Both are None for all images.
+
+    @param params: The script parameters
+    """
+    if params.get(PARAM_ALL_IMAGES):
+        return (None, None)
+    ids = params.get(PARAM_IDS, [0])
+    if params[PARAM_DATATYPE] == 'Dataset':
+        return ("i.id in (select l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids))", ids)
+    if params[PARAM_DATATYPE] == 'Plate':
+        return ("i.id in (select ws.image.id from WellSample ws "
+                "where ws.well.plate.id in (:ids))", ids)
+    if params[PARAM_DATATYPE] == 'Screen':
+        return ("i.id in (select ws.image.id "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids))", ids)
+    return ("i.id in (:ids)", ids)
+
+
+def count_images(conn, params):
+    """
+    Count the images defined in the script parameters
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    (query, count_query, ids) = image_query(params)
+    param = omero.sys.ParametersI()
+    if ids is not None:
+        param.addIds(ids)
+    rows = conn.getQueryService().projection(count_query, param,
+                                             conn.SERVICE_OPTS)
+    return rows and rows[0][0].val or 0
+
+
+def new_image_query(params):
+    """
+    Return the HQL query selecting the IDs of the images defined in the
+    script parameters that were created, or added to the selected container,
+    after the :min event. Old images linked into a dataset, plate or screen
+    are selected by the creation event of the link. The distinct image IDs
+    above the :last parameter are selected in ascending order (see
+    image_query). Returns a tuple of (query, ids) where ids is the value for
+    the :ids parameter (None if not used).
+
+    @param params: The script parameters
+    """
+    if params.get(PARAM_ALL_IMAGES):
+        return ("select i.id from Image i "
+                "where i.details.creationEvent.id > :min and i.id > :last "
+                "order by i.id", None)
+    ids = params.get(PARAM_IDS, [0])
+    if params[PARAM_DATATYPE] == 'Dataset':
+        return ("select distinct l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids) and l.child.id > :last "
+                "and l.details.creationEvent.id > :min "
+                "order by l.child.id", ids)
+    if params[PARAM_DATATYPE] == 'Plate':
+        return ("select distinct ws.image.id from WellSample ws "
+                "where ws.well.plate.id in (:ids) and ws.image.id > :last "
+                "and ws.details.creationEvent.id > :min "
+                "order by ws.image.id", ids)
+    if params[PARAM_DATATYPE] == 'Screen':
+        return ("select distinct ws.image.id "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids) and ws.image.id > :last "
+                "and (ws.details.creationEvent.id > :min "
+                "or l.details.creationEvent.id > :min) "
+                "order by ws.image.id", ids)
+    return ("select i.id from Image i where i.id in (:ids) "
+            "and i.id > :last "
+            "and i.details.creationEvent.id > :min order by i.id", ids)
+
+
+def old_image_count_query(params):
+    """
+    Return the HQL query counting the images defined in the script
+    parameters that were already in the selection at the :min event (the
+    complement of new_image_query). Returns a tuple of (query, ids) where
+    ids is the value for the :ids parameter (None if not used).
+
+    @param params: The script parameters
+    """
+    if params.get(PARAM_ALL_IMAGES):
+        return ("select count(i.id) from Image i "
+                "where i.details.creationEvent.id <= :min", None)
+    ids = params.get(PARAM_IDS, [0])
+    if params[PARAM_DATATYPE] == 'Dataset':
+        return ("select count(distinct l.child.id) from DatasetImageLink l "
+                "where l.parent.id in (:ids) "
+                "and l.details.creationEvent.id <= :min", ids)
+    if params[PARAM_DATATYPE] == 'Plate':
+        return ("select count(distinct ws.image.id) from WellSample ws "
+                "where ws.well.plate.id in (:ids) "
+                "and ws.details.creationEvent.id <= :min", ids)
+    if params[PARAM_DATATYPE] == 'Screen':
+        return ("select count(distinct ws.image.id) "
+                "from WellSample ws, ScreenPlateLink l "
+                "where ws.well.plate.id = l.child.id "
+                "and l.parent.id in (:ids) "
+                "and ws.details.creationEvent.id <= :min "
+                "and l.details.creationEvent.id <= :min", ids)
+    return ("select count(i.id) from Image i where i.id in (:ids) "
+            "and i.details.creationEvent.id <= :min", ids)
+
+
+def current_event(conn):
     """
-    Calculate the raw byte size
+    Return the ID of the latest event on the server (None if there are no
+    events)
+
+    @param conn:   The BlitzGateway connection
+    """
+    rows = conn.getQueryService().projection(
+        "select max(e.id) from Event e", omero.sys.ParametersI(),
+        conn.SERVICE_OPTS)
+    return rows and unwrap(rows[0][0]) or None
+
+
+def iter_image_ids(conn, params, min_id=None):
+    """
+    Generate the IDs of the images defined in the script parameters. The IDs
+    are paged from the server in ascending order by selecting the next page
+    above the last ID (keyset paging) so only one page is held in memory and
+    images deleted during a long run do not shift the later pages.
 
     @param conn:   The BlitzGateway connection
-    @param img:    The ImageWrapper object
     @param params: The script parameters
+    @param min_id: Only generate the IDs created or added to the selection
+                   after this event ID (ignored if None)
     """
-    (x, y, c, z, t) = (img.getSizeX(), img.getSizeY(), img.getSizeC(),
-                       img.getSizeZ(), img.getSizeT())
-    bytes = x * y * c * z * t * bytes_per_pixel(img.getPixelsType())
-    ds = img.getParent()
-    if ds:
-        pr = ds.getParent()
+    if min_id is None:
+        (query, count_query, ids) = image_query(params)
     else:
-        pr = None
+        (query, ids) = new_image_query(params)
+    query_service = conn.getQueryService()
+    last = -1
+    while True:
+        param = omero.sys.ParametersI()
+        if ids is not None:
+            param.addIds(ids)
+        if min_id is not None:
+            param.addLong('min', min_id)
+        param.addLong('last', last)
+        param.page(0, BATCH_SIZE)
+        rows = query_service.projection(query, param, conn.SERVICE_OPTS)
+        for row in rows:
+            last = row[0].val
+            yield last
+        if len(rows) < BATCH_SIZE:
+            break
+
+
+def prefetch_archives(conn, infos, params):
+    """
+    Load the original files of the archived images using one query per batch
+    of pixels IDs. Returns a dictionary of lists of (file ID, size, hash)
+    keyed by pixels ID. The files are in ascending ID order so the last file
+    that identifies the archive is the same for every image of a fileset.
+    Returns an empty dictionary if archived files are not included.
+
+    @param conn:   The BlitzGateway connection
+    @param infos:  The ImageInfo of the images
+    @param params: The script parameters
+    """
+    files = {}
+    if not params[PARAM_ARCHIVED]:
+        return files
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    query_service = conn.getQueryService()
+    for ids in batches([x.pixels_id for x in infos if x.archived]):
+        param = omero.sys.ParametersI()
+        param.addIds(ids)
+        for row in query_service.projection(
+                "select m.child.id, f.id, f.size, f.hash "
+                "from PixelsOriginalFileMap m join m.parent f "
+                "where m.child.id in (:ids) order by m.child.id, f.id",
+                param, ctx):
+            (pixels_id, file_id, size, file_hash) = [unwrap(v) for v in row]
+            files.setdefault(pixels_id, []).append(
+                (file_id, size or 0, file_hash))
+    return files
+
+
+def size_image(conn, info, params, files=None):
+    """
+    Calculate the raw byte size and the archived byte size.
+    Returns a tuple of (bytes, archive_bytes, original file ID, message).
+    The archived bytes are not checked for duplicate original files.
+
+    @param conn:   The BlitzGateway connection
+    @param info:   The ImageInfo of the image
+    @param params: The script parameters
+    @param files:  The prefetched (file ID, size, hash) of the archived files
+                   (loaded if None)
+    """
+    (x, y, c, z, t) = (info.x, info.y, info.c, info.z, info.t)
+    bytes = x * y * c * z * t * bytes_per_pixel(info.pixels_type)
 
     msg = "Image %d : [%s][%s] %s : %s" % (
-          img.getId(),
-          pr and pr.getName() or '-',
-          ds and ds.getName() or '-',
-          img.getName(),
+          info.id,
+          info.project or info.screen or '-',
+          info.dataset or info.plate or '-',
+          info.name,
           convert(bytes))
 
     archive_bytes = 0
-    if params[PARAM_ARCHIVED] and img.getArchived():
-        pids = rlist(rlong(img.getPixelsId()))
-        param = omero.sys.ParametersI()
-        param.add("pids", pids)
-        results = conn.getQueryService().findAllByQuery(
-            "select m from PixelsOriginalFileMap as m join fetch m.parent "
-            "where m.child.id=:pids", param)
-
-        origFile = None
-        for result in results:
-            origFile = result.parent
-            # oid = result.details.owner.id.val
-            p_size = origFile.size.val
+    file_id = None
+    if params[PARAM_ARCHIVED] and info.archived:
+        if files is None:
+            files = prefetch_archives(conn, [info], params).get(
+                info.pixels_id, [])
+
+        for (file_id, p_size, file_hash) in files:
             archive_bytes += p_size
 
-        if origFile:
+        if files:
             msg += " : Archive ID [%d] %s" % (
-                origFile.id.val, convert(archive_bytes))
-
-            # Original files can contain multiple images so only count
-            # archived bytes in total once
-            if origFile.id.val in original_ids:
-                archive_bytes = 0
-            else:
-                original_ids[origFile.id.val] = True
+                file_id, convert(archive_bytes))
         else:
             msg += " : Archive unknown"
 
-    print msg
+    return (bytes, archive_bytes, file_id, msg)
+
+
+class IdSet(object):
+    """
+    Set of non-negative integer IDs stored as a bitmap. Database IDs are
+    dense so this uses one bit per ID up to the largest ID added, much less
+    than a dictionary entry per ID.
+    """
+
+    def __init__(self):
+        self._bits = bytearray()
+
+    def add(self, id):
+        """
+        Add the ID to the set. Returns True if the ID was not in the set.
+
+        @param id:     The ID
+        """
+        (index, mask) = (id >> 3, 1 << (id & 7))
+        if index >= len(self._bits):
+            # Grow by doubling to amortise the copy
+            self._bits.extend(bytearray(
+                max(index + 1, 2 * len(self._bits)) - len(self._bits)))
+        elif self._bits[index] & mask:
+            return False
+        self._bits[index] |= mask
+        return True
+
+    def __contains__(self, id):
+        index = id >> 3
+        return (index < len(self._bits) and
+                bool(self._bits[index] & (1 << (id & 7))))
+
+
+def count_archive(counted, file_id, archive_bytes):
+    """
+    Return the archived bytes to add to the total. Original files can contain
+    multiple images so only count archived bytes in total once.
+
+    @param counted:        The IdSet of original file IDs already counted
+    @param file_id:        The original file ID (can be None)
+    @param archive_bytes:  The archived bytes of the image
+    """
+    if file_id is None or counted.add(file_id):
+        return archive_bytes
+    return 0
+
+
+def process_image(conn, info, params, counted, files=None, snapshot=None):
+    """
+    Calculate the raw byte size and print the report line
+
+    @param conn:     The BlitzGateway connection
+    @param info:     The ImageInfo of the image
+    @param params:   The script parameters
+    @param counted:  The IdSet of original file IDs already counted
+    @param files:    The prefetched (file ID, size, hash) of the archived
+                     files
+                     (loaded if None)
+    @param snapshot: The SizeSnapshot to update (can be None)
+    """
+    (bytes, archive_bytes, file_id, msg) = size_image(conn, info, params,
+                                                      files)
+
+    if show_images(params):
+        print msg
+
+    if snapshot is not None:
+        snapshot.put(info.id, bytes, archive_bytes, file_id)
+
+    return (bytes, count_archive(counted, file_id, archive_bytes))
+
+
+def show_images(params):
+    """Return True if the report line of each image is printed"""
+    return params.get(PARAM_PER_IMAGE) or not (
+        params.get(PARAM_SERVER_TOTALS) or params.get(PARAM_ROLLUPS) or
+        params.get(PARAM_TOP_N))
+
+
+def add_to_plate(plates, info, bytes, archive_bytes):
+    """
+    Add the image sizes to the per-plate totals
+
+    @param plates:         Dictionary of [name, count, bytes, archived]
+                           keyed by plate ID
+    @param info:           The ImageInfo of the image
+    @param bytes:          The raw bytes of the image
+    @param archive_bytes:  The counted archived bytes of the image
+    """
+    if info.plate_id is None:
+        return
+    totals = plates.setdefault(info.plate_id, [info.plate, 0, 0L, 0L])
+    totals[1] += 1
+    totals[2] += bytes
+    totals[3] += archive_bytes
+
+
+def print_plates(plates):
+    """Print the per-plate totals"""
+    for plate_id in sorted(plates):
+        (name, count, total, total_archived) = plates[plate_id]
+        print "Plate %d : %s : %s" % (plate_id, name,
+                                      summary(count, total, total_archived))
+
+
+class Rollup(object):
+    """
+    Accumulate the image count, raw bytes and archived bytes for each key
+    of a grouping level. Keys are mapped to an index into lists of totals
+    so no per-image data is kept. The totals are Python longs as C long
+    arrays overflow past 2 GB on 32-bit platforms and Windows.
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self._index = {}
+        self._names = []
+        self._counts = []
+        self._bytes = []
+        self._archived = []
+
+    def add(self, key, name, bytes, archive_bytes):
+        """Add the image sizes to the totals for the key"""
+        i = self._index.get(key)
+        if i is None:
+            i = self._index[key] = len(self._names)
+            self._names.append(name)
+            self._counts.append(0)
+            self._bytes.append(0L)
+            self._archived.append(0L)
+        self._counts[i] += 1
+        self._bytes[i] += bytes
+        self._archived[i] += archive_bytes
+
+    def rows(self):
+        """
+        Return the (name, count, bytes, archived bytes) of each key sorted
+        by the total bytes, largest first
+        """
+        rows = [(self._names[i], self._counts[i], self._bytes[i],
+                 self._archived[i]) for i in range(len(self._names))]
+        rows.sort(key=lambda x: (-(x[2] + x[3]), x[0]))
+        return rows
+
+
+def create_rollups():
+    """Create the owner, group, project and dataset rollups"""
+    return [Rollup('Owner'), Rollup('Group'), Rollup('Project'),
+            Rollup('Dataset')]
+
+
+def add_to_rollups(rollups, info, bytes, archive_bytes):
+    """
+    Add the image sizes to the rollups
+
+    @param rollups:        The rollups (can be None)
+    @param info:           The ImageInfo of the image
+    @param bytes:          The raw bytes of the image
+    @param archive_bytes:  The counted archived bytes of the image
+    """
+    if not rollups:
+        return
+    (owner, group, project, dataset) = rollups
+    owner.add(info.owner, info.owner, bytes, archive_bytes)
+    group.add(info.group, info.group, bytes, archive_bytes)
+    project.add(info.project_id, info.project or '-', bytes, archive_bytes)
+    dataset.add(info.dataset_id, info.dataset or '-', bytes, archive_bytes)
+
+
+def print_rollups(rollups):
+    """Print the table of totals for each rollup"""
+    for rollup in rollups:
+        for (name, count, total, total_archived) in rollup.rows():
+            print "%s : %s : %s" % (rollup.title, name,
+                                    summary(count, total, total_archived))
+        print "-=-=-=-"
+
+
+class TopN(object):
+    """
+    Keep the N largest items using a bounded min-heap. The smallest of the
+    kept items is replaced when a larger item is added.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self._heap = []
+
+    def add(self, size, key, item):
+        """
+        Add the item if it is one of the N largest
+
+        @param size:   The size of the item
+        @param key:    The unique key of the item used to order equal sizes
+        @param item:   The item
+        """
+        entry = (size, key, item)
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        """Return the (size, key, item) of the kept items, largest first"""
+        return sorted(self._heap, reverse=True)
+
+
+def create_top(params):
+    """
+    Create the (raw, archived) TopN of the largest images, or None if not
+    required
+
+    @param params: The script parameters
+    """
+    n = params.get(PARAM_TOP_N) or 0
+    if n <= 0:
+        return None
+    return (TopN(n), TopN(n))
+
+
+def add_to_top(top, info, bytes, archive_bytes):
+    """
+    Add the image sizes to the largest images
+
+    @param top:            The (raw, archived) TopN (can be None)
+    @param info:           The ImageInfo of the image
+    @param bytes:          The raw bytes of the image
+    @param archive_bytes:  The counted archived bytes of the image
+    """
+    if not top:
+        return
+    top[0].add(bytes, info.id, info)
+    if archive_bytes:
+        top[1].add(archive_bytes, info.id, info)
+
+
+def print_top(top):
+    """Print the largest images by raw and by archived bytes"""
+    for (title, largest) in zip(['Raw', 'Archived'], top):
+        for (rank, (size, image_id, info)) in enumerate(largest.items()):
+            print "Top %s %d : Image %d : [%s][%s] %s : %s" % (
+                title, rank + 1, image_id,
+                info.project or info.screen or '-',
+                info.dataset or info.plate or '-',
+                info.name, convert(size))
+        print "-=-=-=-"
+
+
+class DuplicateArchives(object):
+    """
+    Find archived original files with the same size and stored hash as an
+    earlier file. Each file is checked once. The first file with a given
+    hash is kept and the bytes of later copies are reclaimable. The
+    reclaimable totals are accumulated per image owner.
+    """
+
+    def __init__(self):
+        self._seen = IdSet()
+        self._first = {}
+        self.unhashed = 0
+        # Dictionary of [count, bytes] keyed by owner
+        self.owners = {}
+
+    def add(self, infos, files):
+        """
+        Check the archived files of the images
+
+        @param infos:  The ImageInfo of the images
+        @param files:  Dictionary of lists of (file ID, size, hash) keyed by
+                       pixels ID
+        """
+        for info in infos:
+            for (file_id, size, file_hash) in files.get(info.pixels_id, []):
+                if not self._seen.add(file_id):
+                    continue
+                if not file_hash:
+                    self.unhashed += 1
+                    continue
+                key = (file_hash, size)
+                if key not in self._first:
+                    self._first[key] = file_id
+                    continue
+                totals = self.owners.setdefault(info.owner, [0, 0L])
+                totals[0] += 1
+                totals[1] += size
+
+
+def print_duplicates(duplicates):
+    """Print the reclaimable bytes of duplicate archived files per owner"""
+    count = 0
+    total = 0L
+    rows = sorted(duplicates.owners.items(), key=lambda x: (-x[1][1], x[0]))
+    for (owner, (n, bytes)) in rows:
+        print "Duplicate archives : %s : %d file%s : Reclaimable %s" % (
+            owner, n, n != 1 and 's' or '', convert(bytes))
+        count += n
+        total += bytes
+    print "Duplicate archives : Total : %d file%s : Reclaimable %s" % (
+        count, count != 1 and 's' or '', convert(total))
+    if duplicates.unhashed:
+        print "Duplicate archives : %d file%s without a hash" % (
+            duplicates.unhashed, duplicates.unhashed != 1 and 's' or '')
+    print "-=-=-=-"
+
+
+class SizeSnapshot(object):
+    """
+    On-disk snapshot of the sizes of the selected images. Each entry stores
+    the raw bytes, archived bytes and original file ID of an image so the
+    totals can be updated by sizing only the images added since the last
+    run. The latest event ID seen by the last complete run is the
+    high-water mark for new images. The file holds a separate snapshot for
+    each scope (image selection and group) so different selections do not
+    replace each other.
+    """
+
+    def __init__(self, filename, scope, rebuild=False):
+        filename = os.path.expanduser(filename)
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(filename)
+        self._db.execute(
+            "create table if not exists scopes ("
+            "scope_id integer primary key, scope text unique, mark integer)")
+        self._db.execute(
+            "create table if not exists images ("
+            "scope_id integer, image_id integer, bytes integer, "
+            "archive_bytes integer, file_id integer, "
+            "primary key (scope_id, image_id))")
+        self._db.execute(
+            "insert or ignore into scopes (scope) values (?)", (scope,))
+        (self._scope, mark) = self._db.execute(
+            "select scope_id, mark from scopes where scope=?",
+            (scope,)).fetchone()
+        # A run that did not complete has no mark
+        self.rebuilt = rebuild or mark is None
+        if self.rebuilt:
+            self._db.execute("delete from images where scope_id=?",
+                             (self._scope,))
+            self._db.execute("update scopes set mark=null where scope_id=?",
+                             (self._scope,))
+        self._db.commit()
+        self._changes = 0
+
+    def high_water_mark(self):
+        """
+        Return the event ID up to which the images have been sized (None if
+        the snapshot is empty)
+        """
+        return self._db.execute(
+            "select mark from scopes where scope_id=?",
+            (self._scope,)).fetchone()[0]
+
+    def set_high_water_mark(self, event_id):
+        """
+        Record the event ID up to which the images have been sized
+
+        @param event_id:       The event ID
+        """
+        self._db.execute("update scopes set mark=? where scope_id=?",
+                         (event_id, self._scope))
+        self._db.commit()
+
+    def put(self, image_id, bytes, archive_bytes, file_id):
+        """
+        Record the sizes of an image
+
+        @param image_id:       The image ID
+        @param bytes:          The raw bytes of the image
+        @param archive_bytes:  The archived bytes of the image
+        @param file_id:        The original file ID (can be None)
+        """
+        self._db.execute(
+            "insert or replace into images values (?, ?, ?, ?, ?)",
+            (self._scope, image_id, bytes, archive_bytes, file_id))
+        self._changes += 1
+        if self._changes % 1000 == 0:
+            self._db.commit()
+
+    def _remove(self, image_ids):
+        self._db.executemany(
+            "delete from images where scope_id=? and image_id=?",
+            [(self._scope, x) for x in image_ids])
+        self._db.commit()
+
+    def remove_missing(self, conn, params):
+        """
+        Remove entries for images that have been deleted or are no longer
+        in the selection. Only the changes since the high-water mark are
+        queried: images with a delete event are removed, then the number of
+        images that were already in the selection at the mark is compared
+        with the snapshot. Each entry is only checked on the server if they
+        differ (e.g. an image was removed from a dataset). Returns the number
+        of removed entries.
+
+        @param conn:   The BlitzGateway connection
+        @param params: The script parameters
+        """
+        mark = self.high_water_mark()
+        if mark is None:
+            return 0
+        # Use the same context as the image selection (iter_image_ids)
+        ctx = conn.SERVICE_OPTS
+        query_service = conn.getQueryService()
+        param = omero.sys.ParametersI()
+        param.addLong('min', mark)
+        deleted = [row[0].val for row in query_service.projection(
+            "select distinct el.entityId from EventLog el "
+            "where el.entityType = 'ome.model.core.Image' "
+            "and el.action = 'DELETE' and el.event.id > :min", param, ctx)]
+        before = self.count()
+        self._remove(deleted)
+        removed = before - self.count()
+
+        (query, ids) = old_image_count_query(params)
+        param = omero.sys.ParametersI()
+        param.addLong('min', mark)
+        if ids is not None:
+            param.addIds(ids)
+        rows = query_service.projection(query, param, ctx)
+        if (rows and rows[0][0].val or 0) == self.count():
+            return removed
+
+        cached = [row[0] for row in self._db.execute(
+            "select image_id from images where scope_id=? "
+            "order by image_id", (self._scope,))]
+        (condition, ids) = image_filter(params)
+        query = "select i.id from Image i where i.id in (:images)"
+        if condition:
+            query += " and " + condition
+        missing = []
+        for images in batches(cached):
+            param = omero.sys.ParametersI()
+            param.add('images', rlist([rlong(x) for x in images]))
+            if ids is not None:
+                param.addIds(ids)
+            found = set([row[0].val for row in query_service.projection(
+                query, param, ctx)])
+            missing.extend([x for x in images if x not in found])
+        self._remove(missing)
+        return removed + len(missing)
+
+    def count(self):
+        """Return the number of images in the snapshot"""
+        return self._db.execute(
+            "select count(*) from images where scope_id=?",
+            (self._scope,)).fetchone()[0]
+
+    def totals(self):
+        """
+        Return the (count, total, total_archived) of the images in the
+        snapshot. Archived bytes are counted once per original file.
+        """
+        (count, total) = self._db.execute(
+            "select count(*), coalesce(sum(bytes), 0) from images "
+            "where scope_id=? and bytes > 0", (self._scope,)).fetchone()
+        (archived,) = self._db.execute(
+            "select coalesce(sum(archive_bytes), 0) from images "
+            "where scope_id=? and bytes > 0 and file_id is null",
+            (self._scope,)).fetchone()
+        (shared,) = self._db.execute(
+            "select coalesce(sum(b), 0) from (select max(archive_bytes) b "
+            "from images where scope_id=? and bytes > 0 "
+            "and file_id is not null group by file_id)",
+            (self._scope,)).fetchone()
+        return (count, long(total), long(archived + shared))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def snapshot_scope(conn, params):
+    """
+    Return the description of the image selection that keys the snapshot.
+    Each selection, user and group has its own snapshot as these define the
+    images visible to the queries.
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    if params.get(PARAM_ALL_IMAGES):
+        selection = "All"
+    else:
+        selection = "%s %s" % (params[PARAM_DATATYPE], sorted(
+            params.get(PARAM_IDS, [0])))
+    group_id = conn.SERVICE_OPTS.getOmeroGroup()
+    if group_id is None:
+        group_id = conn.getEventContext().groupId
+    return "%s : Archived=%s : User=%s : Group=%s" % (
+        selection, bool(params[PARAM_ARCHIVED]), conn.getUserId(), group_id)
+
+
+def open_snapshot(conn, params):
+    """
+    Open the size snapshot and remove the images that have been deleted
+    since the last run. Returns a tuple of (snapshot, event ID) where the
+    event ID is the high-water mark to record once the new images are sized.
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    snapshot = SizeSnapshot(SNAPSHOT_FILE % conn.getUserId(),
+                            snapshot_scope(conn, params),
+                            params.get(PARAM_REBUILD))
+    # Read before listing the images so changes made during the run are
+    # picked up by the next run
+    event_id = current_event(conn)
+    if snapshot.rebuilt:
+        print "Snapshot : Full rebuild"
+    else:
+        removed = snapshot.remove_missing(conn, params)
+        print "Snapshot : Changes up to event %s : Removed %d image%s" % (
+            snapshot.high_water_mark(), removed, removed != 1 and 's' or '')
+    print "-=-=-=-"
+    return (snapshot, event_id)
+
+
+def create_worker_connection(conn):
+    """
+    Create a new BlitzGateway connection joined to the session of the given
+    connection.
+
+    @param conn:   The BlitzGateway connection
+    """
+    client = conn.c.createClient(secure=True)
+    return BlitzGateway(client_obj=client)
+
+
+def run_parallel(conn, params, plates, rollups=None, snapshot=None,
+                 top=None, duplicates=None):
+    """
+    Size the images using a pool of worker threads, each with its own
+    BlitzGateway connection. Each worker loads a batch of images and their
+    archived files so the prefetch queries run in parallel. Report lines are
+    printed in the order of the images. Returns a tuple of
+    (count, total, total_archived).
+
+    @param conn:     The BlitzGateway connection
+    @param params:   The script parameters
+    @param plates:   Dictionary of per-plate totals to update
+    @param rollups:  The rollups to update (can be None)
+    @param snapshot: The SizeSnapshot to update (can be None)
+    @param top:      The (raw, archived) TopN to update (can be None)
+    @param duplicates: The DuplicateArchives to update (can be None)
+    """
+    min_id = snapshot and snapshot.high_water_mark()
+    n = params[PARAM_WORKERS]
+    tasks = Queue.Queue(n * 2)
+    results = Queue.Queue()
+
+    # Exception raised by the producer (re-raised in the main thread)
+    errors = []
+
+    def produce():
+        index = 0
+        try:
+            for ids in batches(iter_image_ids(conn, params, min_id)):
+                tasks.put((index, ids))
+                index += 1
+        except Exception, e:
+            errors.append(e)
+        finally:
+            # Always end the work so the workers and main thread finish
+            for i in range(n):
+                tasks.put(None)
+            results.put((index, None, None, None))
+
+    def size_batch(worker_conn, ids):
+        infos = prefetch_images(worker_conn, ids)
+        files = prefetch_archives(worker_conn, infos.values(), params)
+        sized = []
+        for image_id in ids:
+            if image_id not in infos:
+                continue
+            info = infos[image_id]
+            try:
+                result = size_image(worker_conn, info, params,
+                                    files.get(info.pixels_id, []))
+            except Exception, e:
+                result = (0, 0, None, "Image %d : ERROR : %s" % (
+                    info.id, e))
+            sized.append((result, info))
+        return (sized, infos, files)
+
+    def work(worker_conn):
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                (index, ids) = task
+                try:
+                    (sized, infos, files) = size_batch(worker_conn, ids)
+                except Exception, e:
+                    sized = [((0, 0, None, "Image %d : ERROR : %s" % (
+                        image_id, e)), None) for image_id in ids]
+                    (infos, files) = ({}, {})
+                results.put((index, sized, infos, files))
+        finally:
+            worker_conn.c.closeSession()
+
+    threads = [threading.Thread(target=produce)]
+    for i in range(n):
+        threads.append(threading.Thread(
+            target=work, args=(create_worker_connection(conn),)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Re-order the batches to match the input order
+    counted = IdSet()
+    done = 0
+    count = 0
+    total = 0L
+    total_archived = 0L
+    n_tasks = None
+    pending = {}
+    while n_tasks is None or done < n_tasks:
+        (index, sized, infos, files) = results.get()
+        if sized is None:
+            n_tasks = index
+            continue
+        pending[index] = (sized, infos, files)
+        while done in pending:
+            (sized, infos, files) = pending.pop(done)
+            done += 1
+            if duplicates is not None:
+                duplicates.add(infos.values(), files)
+            for ((bytes, archive_bytes, file_id, msg), info) in sized:
+                if show_images(params):
+                    print msg
+                if info is None:
+                    continue
+                if snapshot is not None:
+                    snapshot.put(info.id, bytes, archive_bytes, file_id)
+                archive_bytes = count_archive(counted, file_id,
+                                              archive_bytes)
+                if bytes > 0:
+                    count += 1
+                    total += bytes
+                    total_archived += archive_bytes
+                    add_to_plate(plates, info, bytes, archive_bytes)
+                    add_to_rollups(rollups, info, bytes, archive_bytes)
+                    add_to_top(top, info, bytes, archive_bytes)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return (count, total, total_archived)
+
+
+def server_totals(conn, params, group_by='None'):
+    """
+    Compute the raw byte totals on the server using one aggregate query.
+    The pixel count of the images is summed per pixel type so the bytes are
+    exactly the same as the per-image computation. Returns a dictionary of
+    [name, count, bytes] keyed by the group ID (None when not grouped).
+
+    @param conn:     The BlitzGateway connection
+    @param params:   The script parameters
+    @param group_by: The key of GROUP_BY
+    """
+    (columns, joins, first) = GROUP_BY[group_by]
+    (condition, ids) = image_filter(params)
+    if first:
+        condition = condition and "%s and %s" % (condition, first) or first
+    select = "pt.value"
+    if columns:
+        select += ", " + columns
+    query = ("select %s, count(i.id), "
+             "sum(cast(p.sizeX as long) * p.sizeY * p.sizeZ * p.sizeC * "
+             "p.sizeT) from Image i join i.pixels p join p.pixelsType pt "
+             "%s" % (select, joins))
+    if condition:
+        query += "where %s " % condition
+    query += "group by %s" % select
+    param = omero.sys.ParametersI()
+    if ids is not None:
+        param.addIds(ids)
+    totals = {}
+    for row in conn.getQueryService().projection(query, param,
+                                                 conn.SERVICE_OPTS):
+        row = [unwrap(v) for v in row]
+        if columns:
+            (pixels_type, key, name, count, pixels) = row
+        else:
+            (pixels_type, count, pixels) = row
+            key = name = None
+        entry = totals.setdefault(key, [name, 0, 0L])
+        entry[1] += count
+        entry[2] += pixels * bytes_per_pixel(pixels_type)
+    return totals
+
+
+def server_archived(conn, params):
+    """
+    Compute the archived byte total on the server using one aggregate query.
+    Each original file is counted once.
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    (condition, ids) = image_filter(params)
+    query = ("select sum(f.size) from OriginalFile f where f.id in ("
+             "select m.parent.id from PixelsOriginalFileMap m "
+             "join m.child p join p.image i where i.archived = true")
+    if condition:
+        query += " and " + condition
+    query += ")"
+    param = omero.sys.ParametersI()
+    if ids is not None:
+        param.addIds(ids)
+    rows = conn.getQueryService().projection(query, param, conn.SERVICE_OPTS)
+    return rows and unwrap(rows[0][0]) or 0
+
+
+def run_aggregate(conn, params):
+    """
+    Compute the totals using aggregate queries on the server. The image lines
+    are only reported if requested. Returns a tuple of (count, total,
+    total_archived).
+
+    @param conn:   The BlitzGateway connection
+    @param params: The script parameters
+    """
+    if params.get(PARAM_PER_IMAGE):
+        run_images(conn, params, {})
+        print "-=-=-=-"
+
+    group_by = params.get(PARAM_GROUP_BY) or 'None'
+    if group_by != 'None':
+        totals = server_totals(conn, params, group_by)
+        rows = sorted(totals.items(), key=lambda x: (-x[1][2], x[0]))
+        for (key, (name, count, total)) in rows:
+            print "%s %s : %s : %s" % (
+                group_by, key is None and '-' or key, name or '-',
+                summary(count, total, 0))
+        print "-=-=-=-"
+
+    (name, count, total) = server_totals(conn, params).get(
+        None, [None, 0, 0L])
+    total_archived = 0L
+    if params.get(PARAM_ARCHIVED):
+        total_archived = server_archived(conn, params)
+    return (count, total, total_archived)
+
 
-    return (bytes, archive_bytes)
+def run_images(conn, params, plates, rollups=None, snapshot=None,
+               top=None, duplicates=None):
+    """
+    Calculate the size of each image and print the report lines. If a
+    snapshot is used only the images added since the snapshot are sized.
+    Returns a tuple of (count, total, total_archived) of the sized images.
+
+    @param conn:     The BlitzGateway connection
+    @param params:   The script parameters
+    @param plates:   Dictionary of per-plate totals to update
+    @param rollups:  The rollups to update (can be None)
+    @param snapshot: The SizeSnapshot to update (can be None)
+    @param top:      The (raw, archived) TopN to update (can be None)
+    @param duplicates: The DuplicateArchives to update (can be None)
+    """
+    if params.get(PARAM_WORKERS, 1) > 1:
+        return run_parallel(conn, params, plates, rollups, snapshot, top,
+                            duplicates)
+
+    min_id = snapshot and snapshot.high_water_mark()
+    counted = IdSet()
+    count = 0
+    total = 0L
+    total_archived = 0L
+    for ids in batches(iter_image_ids(conn, params, min_id)):
+        infos = prefetch_images(conn, ids)
+        files = prefetch_archives(conn, infos.values(), params)
+        if duplicates is not None:
+            duplicates.add(infos.values(), files)
+        for image_id in ids:
+            if image_id not in infos:
+                continue
+            info = infos[image_id]
+            (bytes, archived_bytes) = process_image(
+                conn, info, params, counted, files.get(info.pixels_id, []),
+                snapshot)
+            if bytes > 0:
+                count += 1
+                total += bytes
+                total_archived += archived_bytes
+                add_to_plate(plates, info, bytes, archived_bytes)
+                add_to_rollups(rollups, info, bytes, archived_bytes)
+                add_to_top(top, info, bytes, archived_bytes)
+    return (count, total, total_archived)
 
 
 def run(conn, params):
@@ -186,40 +1305,55 @@ def run(conn, params):
     else:
         convert = convert_raw
 
-    images = []
-    if params.get(PARAM_ALL_IMAGES):
-        images = list(conn.getObjects('Image'))
-    else:
-        objects = conn.getObjects(params[PARAM_DATATYPE],
-                                  params.get(PARAM_IDS, [0]))
-        if params[PARAM_DATATYPE] == 'Dataset':
-            for ds in objects:
-                images.extend(list(ds.listChildren()))
-        else:
-            images = list(objects)
-
-        # Remove duplicate images in multiple datasets
-        seen = set()
-        images = [x for x in images if x.id not in seen and not seen.add(x.id)]
+    n_images = count_images(conn, params)
 
     print("Processing %s image%s" % (
-        len(images), len(images) != 1 and 's' or ''))
+        n_images, n_images != 1 and 's' or ''))
 
     print "-=-=-=-"
 
-    count = 0
-    total = 0L
-    total_archived = 0L
-    for img in images:
-        if (img is not None):
-            (bytes, archived_bytes) = process_image(conn, img, params)
-            if bytes > 0:
-                count += 1
-                total += bytes
-                total_archived += archived_bytes
+    if params.get(PARAM_SERVER_TOTALS):
+        return run_aggregate(conn, params)
+
+    plates = {}
+    rollups = params.get(PARAM_ROLLUPS) and create_rollups() or None
+    top = create_top(params)
+    duplicates = None
+    if params.get(PARAM_DUPLICATES) and params[PARAM_ARCHIVED]:
+        duplicates = DuplicateArchives()
+    snapshot = None
+    if params.get(PARAM_SNAPSHOT):
+        (snapshot, event_id) = open_snapshot(conn, params)
+    try:
+        (count, total, total_archived) = run_images(
+            conn, params, plates, rollups, snapshot, top, duplicates)
+        if snapshot and event_id is not None:
+            snapshot.set_high_water_mark(event_id)
 
-    if count:
-        print "-=-=-=-"
+        if count and show_images(params):
+            print "-=-=-=-"
+
+        if plates:
+            print_plates(plates)
+            print "-=-=-=-"
+
+        if rollups:
+            print_rollups(rollups)
+
+        if top:
+            print_top(top)
+
+        if duplicates:
+            print_duplicates(duplicates)
+
+        if snapshot:
+            print "Snapshot : New %s" % summary(count, total,
+                                                total_archived)
+            print "-=-=-=-"
+            (count, total, total_archived) = snapshot.totals()
+    finally:
+        if snapshot:
+            snapshot.close()
 
     return (count, total, total_archived)
 
@@ -258,6 +1392,15 @@ def run_as_program():
     params[PARAM_DATATYPE] = "Image"
     params[PARAM_ARCHIVED] = True
     params[PARAM_READABLE] = True
+    params[PARAM_WORKERS] = 1
+    params[PARAM_SERVER_TOTALS] = False
+    params[PARAM_GROUP_BY] = 'None'
+    params[PARAM_ROLLUPS] = False
+    params[PARAM_PER_IMAGE] = True
+    params[PARAM_SNAPSHOT] = False
+    params[PARAM_REBUILD] = False
+    params[PARAM_TOP_N] = 0
+    params[PARAM_DUPLICATES] = False
 
     global raw_bytes
     raw_bytes = False
@@ -272,7 +1415,10 @@ def run_as_script():
     The main entry point of the script, as called by the client via the
     scripting service, passing the required parameters.
     """
-    dataTypes = [rstring('Dataset'), rstring('Image')]
+    dataTypes = [rstring('Dataset'), rstring('Image'), rstring('Plate'),
+                 rstring('Screen')]
+    groupBy = [rstring(x) for x in
+               ['None', 'Owner', 'Group', 'Project', 'Dataset']]
 
     client = scripts.client('Image_Size.py', """\
 Report the raw byte size of each image.
@@ -281,6 +1427,23 @@ Report the raw byte size of each image.
 
 Optionally includes the original file size (if archived during import).
 
+Plates and Screens report the totals per plate.
+
+Optionally the totals are computed on the server using aggregate queries,
+grouped by owner, group, project or dataset. Image lines are then optional.
+
+Optionally the totals per owner, group, project and dataset are accumulated
+while sizing the images.
+
+Optionally the sizes are stored in a snapshot file. Subsequent runs only size
+the images added since the snapshot, remove deleted images and report the
+updated totals. Plate totals, rollups and image lines cover the new images.
+
+Optionally the N largest images by raw and by archived bytes are reported.
+
+Optionally archived files with the same size and hash as another archived
+file are reported as reclaimable bytes per owner.
+
 See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/imagesize""",  # noqa
 
     scripts.String(PARAM_DATATYPE, optional=False, grouping="1.1",
@@ -288,7 +1451,8 @@ See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/imagesize"""
         default="Image"),
 
     scripts.List(PARAM_IDS, optional=True, grouping="1.2",
-        description="List of Dataset IDs or Image IDs").ofType(rlong(0)),
+        description="List of Dataset, Image, Plate or Screen IDs"
+        ).ofType(rlong(0)),
 
     scripts.Bool(PARAM_ALL_IMAGES, grouping="1.3",
         description="Process all images (ignore the ID parameters)",
@@ -302,6 +1466,49 @@ See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/imagesize"""
         description="Include archived files",
         default=True),
 
+    scripts.Int(PARAM_WORKERS, grouping="6",
+        description="Number of parallel sessions used to load and size "
+                    "the images",
+        default=1, min=1, max=32),
+
+    scripts.Bool(PARAM_SERVER_TOTALS, grouping="7",
+        description="Compute the totals on the server using aggregate "
+                    "queries",
+        default=False),
+
+    scripts.String(PARAM_GROUP_BY, grouping="7.1",
+        description="Report the server totals for each group",
+        values=groupBy, default="None"),
+
+    scripts.Bool(PARAM_ROLLUPS, grouping="8",
+        description="Report the totals per owner, group, project and "
+                    "dataset",
+        default=False),
+
+    scripts.Bool(PARAM_PER_IMAGE, grouping="9",
+        description="Report the size of each image when using server "
+                    "totals or rollups",
+        default=False),
+
+    scripts.Bool(PARAM_SNAPSHOT, grouping="10",
+        description="Update the totals incrementally using a snapshot of "
+                    "the selection stored for the user on the server",
+        default=False),
+
+    scripts.Bool(PARAM_REBUILD, grouping="10.1",
+        description="Rebuild the snapshot by sizing all the images",
+        default=False),
+
+    scripts.Int(PARAM_TOP_N, grouping="11",
+        description="Report the N largest images by raw and by archived "
+                    "bytes (0 to disable)",
+        default=0, min=0),
+
+    scripts.Bool(PARAM_DUPLICATES, grouping="12",
+        description="Report duplicate archived files using the stored "
+                    "file hash",
+        default=False),
+
     version="1.0",
     authors=["Alex Herbert", "GDSC"],
     institutions=["University of Sussex"],
@@ -11,6 +11,9 @@ using an ROI defined on a single image plane.
 
 import os
 import time
+import threading
+import Queue
+import numpy
 
 import omero
 import omero.scripts as scripts
@@ -19,6 +22,14 @@ from omero.rtypes import *  # noqa
 
 startTime = 0
 
+# Map the OMERO pixel type to the numpy data type
+PIXEL_DTYPES = {
+    'int8': numpy.int8, 'uint8': numpy.uint8,
+    'int16': numpy.int16, 'uint16': numpy.uint16,
+    'int32': numpy.int32, 'uint32': numpy.uint32,
+    'float': numpy.float32, 'double': numpy.float64,
+}
+
 
 def splitext(filename):
     """
@@ -93,6 +104,473 @@ def getRectangles(conn, imageId):
     return rois
 
 
+def getRegion(image, r, parameterMap):
+    """
+    Returns the (x, y, w, h, zStart, zEnd, tStart, tEnd) of the ROI clipped to
+    the image bounds and extended through the stack if required
+    """
+    x, y, w, h, z1, z2, t1, t2 = r
+    W = image.getSizeX()
+    H = image.getSizeY()
+    # Bounding box
+    if x < 0:
+        x = 0
+    if y < 0:
+        y = 0
+    if x + w > W:
+        w = W - x
+    if y + h > H:
+        h = H - y
+
+    if parameterMap['Entire_Stack']:
+        if parameterMap['Z_Stack']:
+            z1 = 0
+            z2 = image.getSizeZ() - 1
+        if parameterMap['T_Stack']:
+            t1 = 0
+            t2 = image.getSizeT() - 1
+
+    return (x, y, w, h, z1, z2, t1, t2)
+
+
+def overlaps(a, b):
+    """
+    Returns True if the (x, y, w, h) rectangles overlap
+    """
+    return (a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and
+            a[1] < b[1] + b[3] and b[1] < a[1] + a[3])
+
+
+def union(a, b):
+    """
+    Returns the (x, y, w, h) bounding rectangle of the rectangles
+    """
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, max(a[0] + a[2], b[0] + b[2]) - x,
+            max(a[1] + a[3], b[1] + b[3]) - y)
+
+
+def area(rect):
+    """
+    Returns the area of the (x, y, w, h) rectangle
+    """
+    return rect[2] * rect[3]
+
+
+def mergeRects(rects):
+    """
+    Merges overlapping (x, y, w, h) rectangles into their bounding rectangles
+    until no further merge is possible. Rectangles are only merged if the
+    bounding rectangle is no larger than the two rectangles, so the merged
+    area never exceeds the area of the input rectangles. Returns the list of
+    merged rectangles (None if merged into another) and the index of the
+    merged rectangle containing each input rectangle.
+    """
+    merged = list(rects)
+    owner = range(len(rects))
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a = merged[i]
+                b = merged[j]
+                if (a and b and overlaps(a, b) and
+                        area(union(a, b)) <= area(a) + area(b)):
+                    merged[i] = union(a, b)
+                    merged[j] = None
+                    owner = [i if k == j else k for k in owner]
+                    changed = True
+    return (merged, owner)
+
+
+class SharedTileReader(object):
+    """
+    Reads the tiles of multiple regions of the same pixels. Overlapping
+    regions in each Z/C/T plane are merged into their union bounding region
+    (see mergeRects) which is read from the server once. The tile of each
+    region is a NumPy view of the union region. A union region is kept until
+    every region using it has been read, so the regions of each group are
+    read plane by plane (see createRoiImageGroup) to hold at most the union
+    regions of one plane. The reader can be shared between threads; each
+    thread reads with its own raw pixels store (see openStore) outside the
+    lock. The union regions of a group are only used by the group so each
+    group must be read by a single thread.
+    """
+
+    def __init__(self, pixelsId, pixelsType, regions, sizeC):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pixelsId = pixelsId
+        self._dtype = numpy.dtype(PIXEL_DTYPES[pixelsType])
+        self._regions = regions
+        self._cache = {}
+        self._counts = {}
+        self._targets = {}
+        self.bytesRead = 0
+        # The first region using each union region. Regions sharing a union
+        # region are joined into the same group.
+        first = {}
+        group = range(len(regions))
+
+        # The regions that use each plane
+        planes = {}
+        for index, region in enumerate(regions):
+            x, y, w, h, z1, z2, t1, t2 = region
+            for z in range(z1, z2+1):
+                for c in range(sizeC):
+                    for t in range(t1, t2+1):
+                        planes.setdefault((z, c, t), []).append(index)
+
+        # Most planes are used by the same set of regions
+        plans = {}
+        for (plane, indices) in planes.items():
+            key = tuple(indices)
+            if key not in plans:
+                plans[key] = mergeRects([regions[i][:4] for i in indices])
+            (merged, owner) = plans[key]
+            for (index, k) in zip(indices, owner):
+                target = plane + merged[k]
+                self._targets[(index,) + plane] = target
+                self._counts[target] = self._counts.get(target, 0) + 1
+                other = first.setdefault(target, index)
+                if group[index] != group[other]:
+                    old = group[index]
+                    group = [group[other] if g == old else g for g in group]
+
+        groups = {}
+        for index, g in enumerate(group):
+            groups.setdefault(g, []).append(index)
+        self.groups = sorted(groups.values())
+
+    def getTile(self, index, z, c, t):
+        """
+        Returns the tile of the region in the plane
+        """
+        x, y, w, h = self._regions[index][:4]
+        with self._lock:
+            target = self._targets.pop((index, z, c, t))
+            tile = self._cache.get(target)
+        if tile is None:
+            tile = self._read(target)
+        with self._lock:
+            self._counts[target] -= 1
+            if self._counts[target]:
+                self._cache[target] = tile
+            else:
+                del self._counts[target]
+                self._cache.pop(target, None)
+        ux, uy = target[3], target[4]
+        return tile[y - uy:y - uy + h, x - ux:x - ux + w]
+
+    def _read(self, target):
+        z, c, t, x, y, w, h = target
+        raw = self._local.store.getTile(z, c, t, x, y, w, h)
+        with self._lock:
+            self.bytesRead += len(raw)
+        tile = numpy.fromstring(raw, dtype=self._dtype.newbyteorder('>'))
+        return tile.astype(self._dtype).reshape(h, w)
+
+    def openStore(self, conn):
+        """
+        Opens the raw pixels store used to read the tiles in the current
+        thread
+        """
+        self._local.store = conn.c.sf.createRawPixelsStore()
+        self._local.store.setPixelsId(self._pixelsId, True, conn.SERVICE_OPTS)
+
+    def closeStore(self):
+        """
+        Closes the raw pixels store of the current thread
+        """
+        self._local.store.close()
+
+
+def createDescription(imageId, imageName, region):
+    """
+    Returns the description of the new image created from the region
+    """
+    x, y, w, h = region[:4]
+    return """\
+Created from Image ID: %d
+  Name: %s
+  x: %d y: %d w: %d h: %d""" % (imageId, imageName, x, y, w, h)
+
+
+def createRoiImage(conn, pixels, imageId, imageName, index, region, sizeC):
+    """
+    Creates a new 5D image from the region of the source pixels and returns
+    the new image ID. The tiles are read from the pixels and written to the
+    new image using raw pixel stores of the given connection. The channel
+    details, pixel sizes and dataset link are applied to all the new images
+    afterwards (see applyMetadata and linkImages).
+    """
+    x, y, w, h, z1, z2, t1, t2 = region
+
+    # need a tile generator to get all the planes within the ROI
+    sizeZ = z2-z1 + 1
+    sizeT = t2-t1 + 1
+    zctTileList = []
+    tile = (x, y, w, h)
+    for z in range(z1, z2+1):
+        for c in range(sizeC):
+            for t in range(t1, t2+1):
+                zctTileList.append((z, c, t, tile))
+
+    def tileGen():
+        for i, t in enumerate(pixels.getTiles(zctTileList)):
+            yield t
+
+    description = createDescription(imageId, imageName, region)
+    # make sure that script_utils creates a NEW rawPixelsStore
+    serviceFactory = conn.c.sf  # noqa
+    newI = conn.createImageFromNumpySeq(
+        tileGen(), createImageName(imageName, index),
+        sizeZ=sizeZ, sizeC=sizeC, sizeT=sizeT, description=description)
+
+    return newI.getId()
+
+
+def applyMetadata(conn, iIds, channels, physicalSizes):
+    """
+    Applies the original channel details and pixel sizes to the new images.
+    The pixels of all the images are loaded with one query, saved with one
+    call and the rendering settings are reset with one call so the number of
+    server calls does not depend on the number of images or channels.
+    """
+    physicalSizeX, physicalSizeY, physicalSizeZ = physicalSizes
+    params = omero.sys.ParametersI()
+    params.addIds(iIds)
+    allPixels = conn.getQueryService().findAllByQuery(
+        "select distinct p from Pixels p join fetch p.channels c "
+        "join fetch c.logicalChannel where p.image.id in (:ids)",
+        params, conn.SERVICE_OPTS)
+
+    for newPixels in allPixels:
+        # Apply the original channel names and colors
+        for i, c in enumerate(newPixels.copyChannels()):
+            (name, emWave, exWave) = channels[i]
+            lc = c.getLogicalChannel()
+            lc.setEmissionWave(rint(emWave))
+            lc.setExcitationWave(rint(exWave))
+            lc.setName(rstring(name))
+
+        # Apply the original pixel size
+        newPixels.setPhysicalSizeX(rdouble(physicalSizeX))
+        newPixels.setPhysicalSizeY(rdouble(physicalSizeY))
+        newPixels.setPhysicalSizeZ(rdouble(physicalSizeZ))
+
+    conn.getUpdateService().saveArray(allPixels, conn.SERVICE_OPTS)
+
+    # Create the rendering settings using the new channel colors
+    conn.getRenderingSettingsService().resetDefaultsInSet(
+        "Image", iIds, conn.SERVICE_OPTS)
+
+
+def linkImages(conn, datasetId, iIds):
+    """
+    Links the images to the dataset using one call
+    """
+    links = []
+    for iid in iIds:
+        link = omero.model.DatasetImageLinkI()
+        link.parent = omero.model.DatasetI(datasetId, False)
+        link.child = omero.model.ImageI(iid, False)
+        links.append(link)
+    conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+
+
+def createWorkerConnection(conn):
+    """
+    Creates a new BlitzGateway connection joined to the session of the given
+    connection
+    """
+    client = conn.c.createClient(secure=True)
+    return BlitzGateway(client_obj=client)
+
+
+def createRoiImagesInParallel(conn, imageId, imageName, regions, sizeC,
+                              workers):
+    """
+    Creates the new images from the (index, region) list using a pool of
+    worker threads. Each worker has its own connection so the tiles are read
+    and uploaded using separate raw pixel stores. Returns the new image IDs
+    in the order of the region index.
+    """
+    tasks = Queue.Queue()
+    for task in regions:
+        tasks.put(task)
+    results = {}
+    errors = []
+
+    def work(workerConn):
+        try:
+            pixels = workerConn.getObject("Image", imageId).getPrimaryPixels()
+            while not errors:
+                try:
+                    (index, region) = tasks.get_nowait()
+                except Queue.Empty:
+                    break
+                results[index] = createRoiImage(
+                    workerConn, pixels, imageId, imageName, index, region,
+                    sizeC)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            workerConn.c.closeSession()
+
+    threads = []
+    for i in range(min(workers, len(regions))):
+        threads.append(threading.Thread(
+            target=work, args=(createWorkerConnection(conn),)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return [results[index] for index in sorted(results)]
+
+
+def createRoiImageGroup(conn, imageId, imageName, pixelsType, indices,
+                        regions, sizeC, reader):
+    """
+    Creates the new images of a group of regions that share union regions
+    and returns the new image IDs in the order of the indices. The images
+    are created empty and written with one raw pixel store each while the
+    planes of the source are visited in Z/C/T order, so each union region is
+    read once and released as soon as every region in the plane has been
+    written.
+    """
+    pixelsService = conn.getPixelsService()
+    queryService = conn.getQueryService()
+    params = omero.sys.ParametersI()
+    params.add('pType', rstring(pixelsType))
+    pType = queryService.findByQuery(
+        "from PixelsType as p where p.value=:pType", params,
+        conn.SERVICE_OPTS)
+    dtype = numpy.dtype(PIXEL_DTYPES[pixelsType]).newbyteorder('>')
+
+    iIds = []
+    for index in indices:
+        x, y, w, h, z1, z2, t1, t2 = regions[index]
+        iIds.append(pixelsService.createImage(
+            w, h, z2-z1 + 1, t2-t1 + 1, range(sizeC), pType,
+            createImageName(imageName, index),
+            createDescription(imageId, imageName, regions[index]),
+            conn.SERVICE_OPTS).getValue())
+    params = omero.sys.ParametersI()
+    params.addIds(iIds)
+    pixelsIds = dict([(unwrap(iid), unwrap(pid)) for (iid, pid) in
+                      queryService.projection(
+                          "select p.image.id, p.id from Pixels p "
+                          "where p.image.id in (:ids)",
+                          params, conn.SERVICE_OPTS)])
+
+    # The regions that use each plane
+    planes = {}
+    for index in indices:
+        x, y, w, h, z1, z2, t1, t2 = regions[index]
+        for z in range(z1, z2+1):
+            for c in range(sizeC):
+                for t in range(t1, t2+1):
+                    planes.setdefault((z, c, t), []).append(index)
+
+    stores = {}
+    limits = {}
+    try:
+        for (index, iid) in zip(indices, iIds):
+            stores[index] = conn.c.sf.createRawPixelsStore()
+            stores[index].setPixelsId(pixelsIds[iid], True,
+                                      conn.SERVICE_OPTS)
+        for (z, c, t) in sorted(planes):
+            for index in planes[(z, c, t)]:
+                x, y, w, h, z1, z2, t1, t2 = regions[index]
+                tile = reader.getTile(index, z, c, t)
+                stores[index].setPlane(tile.astype(dtype).tostring(),
+                                       z - z1, c, t - t1, conn.SERVICE_OPTS)
+                (lo, hi) = limits.get((index, c), (tile.min(), tile.max()))
+                limits[(index, c)] = (min(lo, tile.min()),
+                                      max(hi, tile.max()))
+        for ((index, c), (lo, hi)) in limits.items():
+            pixelsService.setChannelGlobalMinMax(
+                pixelsIds[iIds[indices.index(index)]], c, float(lo),
+                float(hi), conn.SERVICE_OPTS)
+    finally:
+        for store in stores.values():
+            store.close()
+    return iIds
+
+
+def createRoiImagesFromSharedReads(conn, image, regions, sizeC, workers):
+    """
+    Creates the new images from the regions reading each union region of
+    overlapping regions from the server once. Each group of overlapping
+    regions is created by one of a pool of at most the given number of
+    worker threads (see createRoiImageGroup), so only the union regions of
+    the plane being written by each worker are held in memory. Returns the
+    new image IDs in the order of the regions.
+    """
+    imageId = image.getId()
+    imageName = image.getName()
+    pixelsType = image.getPixelsType()
+    reader = SharedTileReader(image.getPrimaryPixels().getId(), pixelsType,
+                              regions, sizeC)
+    tasks = Queue.Queue()
+    for group in reader.groups:
+        tasks.put(group)
+    results = {}
+    errors = []
+
+    def work(workerConn):
+        try:
+            reader.openStore(workerConn)
+            try:
+                while not errors:
+                    try:
+                        group = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    results.update(zip(group, createRoiImageGroup(
+                        workerConn, imageId, imageName, pixelsType, group,
+                        regions, sizeC, reader)))
+            finally:
+                reader.closeStore()
+        except Exception, e:
+            errors.append(e)
+        finally:
+            if workerConn is not conn:
+                workerConn.c.closeSession()
+
+    n = min(workers, len(reader.groups))
+    if n > 1:
+        threads = []
+        for i in range(n):
+            threads.append(threading.Thread(
+                target=work, args=(createWorkerConnection(conn),)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        work(conn)
+
+    if errors:
+        raise errors[0]
+    iIds = [results[index] for index in sorted(results)]
+
+    requested = sum([w * h * (z2 - z1 + 1) * (t2 - t1 + 1)
+                     for (x, y, w, h, z1, z2, t1, t2) in regions])
+    requested *= sizeC * numpy.dtype(PIXEL_DTYPES[pixelsType]).itemsize
+    print "Shared reads: %d bytes read for %d bytes of ROIs" % (
+        reader.bytesRead, requested)
+    return iIds
+
+
 def processImage(conn, imageId, parameterMap):
     """
     Process an image.
@@ -103,6 +581,8 @@ def processImage(conn, imageId, parameterMap):
 
     createDataset = parameterMap['New_Dataset']
     datasetName = parameterMap['New_Dataset_Name']
+    workers = parameterMap.get('Workers', 1)
+    sharedReads = parameterMap.get('Shared_Reads', False)
 
     image = conn.getObject("Image", imageId)
     if image is None:
@@ -119,106 +599,50 @@ def processImage(conn, imageId, parameterMap):
     updateService = conn.getUpdateService()
 
     pixels = image.getPrimaryPixels()
-    W = image.getSizeX()
-    H = image.getSizeY()
 
     # note pixel sizes (if available) to set for the new images
-    physicalSizeX = pixels.getPhysicalSizeX()
-    physicalSizeY = pixels.getPhysicalSizeY()
-    physicalSizeZ = pixels.getPhysicalSizeZ()
+    physicalSizes = (pixels.getPhysicalSizeX(), pixels.getPhysicalSizeY(),
+                     pixels.getPhysicalSizeZ())
 
     # Store original channel details
-    cNames = []
-    emWaves = []
-    exWaves = []
+    channels = []
     for index, c in enumerate(image.getChannels()):
         lc = c.getLogicalChannel()
-        cNames.append(str(c.getLabel()))
-        emWaves.append(lc.getEmissionWave())
-        exWaves.append(lc.getExcitationWave())
+        channels.append((str(c.getLabel()), lc.getEmissionWave(),
+                         lc.getExcitationWave()))
 
     # x, y, w, h, zStart, zEnd, tStart, tEnd
     rois = getRectangles(conn, imageId)
     print "rois"
     print rois
 
-    # Make a new 5D image per ROI
-    iIds = []
-    for index, r in enumerate(rois):
-        x, y, w, h, z1, z2, t1, t2 = r
-        # Bounding box
-        if x < 0:
-            x = 0
-        if y < 0:
-            y = 0
-        if x + w > W:
-            w = W - x
-        if y + h > H:
-            h = H - y
-
-        if parameterMap['Entire_Stack']:
-            if parameterMap['Z_Stack']:
-                z1 = 0
-                z2 = image.getSizeZ() - 1
-            if parameterMap['T_Stack']:
-                t1 = 0
-                t2 = image.getSizeT() - 1
-
+    regions = []
+    for r in rois:
+        region = getRegion(image, r, parameterMap)
         print "  ROI x: %s y: %s w: %s h: %s z1: %s z2: %s t1: %s t2: %s" % (
-            x, y, w, h, z1, z2, t1, t2)
-
-        # need a tile generator to get all the planes within the ROI
-        sizeZ = z2-z1 + 1
-        sizeT = t2-t1 + 1
-        sizeC = image.getSizeC()
-        zctTileList = []
-        tile = (x, y, w, h)
-        print "zctTileList..."
-        for z in range(z1, z2+1):
-            for c in range(sizeC):
-                for t in range(t1, t2+1):
-                    zctTileList.append((z, c, t, tile))
+            region)
+        regions.append(region)
+
+    # Make a new 5D image per ROI
+    sizeC = len(channels)
+    if sharedReads and len(regions) > 1:
+        iIds = createRoiImagesFromSharedReads(conn, image, regions, sizeC,
+                                              workers)
+    elif workers > 1 and len(regions) > 1:
+        iIds = createRoiImagesInParallel(conn, imageId, imageName,
+                                         list(enumerate(regions)), sizeC,
+                                         workers)
+    else:
+        iIds = []
+        for index, region in enumerate(regions):
+            iIds.append(createRoiImage(conn, pixels, imageId, imageName,
+                                       index, region, sizeC))
 
-        def tileGen():
-            for i, t in enumerate(pixels.getTiles(zctTileList)):
-                yield t
+    if len(iIds) > 0:
+        applyMetadata(conn, iIds, channels, physicalSizes)
 
-        print "sizeZ, sizeC, sizeT", sizeZ, sizeC, sizeT
-        description = """\
-Created from Image ID: %d
-  Name: %s
-  x: %d y: %d w: %d h: %d""" % (imageId, imageName, x, y, w, h)
-        # make sure that script_utils creates a NEW rawPixelsStore
-        serviceFactory = conn.c.sf  # noqa
-        newI = conn.createImageFromNumpySeq(
-            tileGen(), createImageName(imageName, index),
-            sizeZ=sizeZ, sizeC=sizeC, sizeT=sizeT, description=description,
-            dataset=dataset)
-        iIds.append(newI.getId())
-
-        # Apply colors from the original image to the new one
-        if newI._prepareRenderingEngine():
-            renderingEngine = newI._re
-
-            # Apply the original channel names
-            newPixels = renderingEngine.getPixels()
-
-            for i, c in enumerate(newPixels.iterateChannels()):
-                lc = c.getLogicalChannel()
-                lc.setEmissionWave(rint(emWaves[i]))
-                lc.setExcitationWave(rint(exWaves[i]))
-                lc.setName(rstring(cNames[i]))
-                updateService.saveObject(lc)
-
-            renderingEngine.resetDefaults()
-
-        # Apply the original pixel size - Get the object again to refresh state
-        newImg = conn.getObject("Image", newI.getId())
-        newPixels = newImg.getPrimaryPixels()
-        newPixels.setPhysicalSizeX(rdouble(physicalSizeX))
-        newPixels.setPhysicalSizeY(rdouble(physicalSizeY))
-        newPixels.setPhysicalSizeZ(rdouble(physicalSizeZ))
-        newPixels.save()
+    if len(iIds) > 0 and dataset:
+        linkImages(conn, dataset.getId(), iIds)
 
     if len(iIds) > 0 and createDataset:
 
@@ -233,11 +657,7 @@ Name: %s
 Image ID: %d""" % (imageName, imageId)
         dataset.description = rstring(desc)
         dataset = updateService.saveAndReturnObject(dataset)
-        for iid in iIds:
-            link = omero.model.DatasetImageLinkI()
-            link.parent = omero.model.DatasetI(dataset.id.val, False)
-            link.child = omero.model.ImageI(iid, False)
-            updateService.saveObject(link)
+        linkImages(conn, dataset.id.val, iIds)
         if parentProject:        # and put it in the current project
             link = omero.model.ProjectDatasetLinkI()
             link.parent = omero.model.ProjectI(parentProject.getId(), False)
@@ -287,6 +707,10 @@ def runAsScript():
 Designed to work with multi-plane images with multiple ROIs per image.
 ROIs can span part of the z-stack.
 
+Multiple ROIs can be cropped at the same time using parallel sessions.
+
+Overlapping ROIs can share the pixel data read from the server.
+
 See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/rois""",
 
     scripts.String("Data_Type", optional=False, grouping="1",
@@ -314,6 +738,17 @@ See: http://www.sussex.ac.uk/gdsc/intranet/microscopy/omero/scripts/rois""",
     scripts.String("New_Dataset_Name", grouping="4.1",
         description="New Dataset name", default="From_ROIs"),
 
+    scripts.Int("Workers", grouping="5",
+        description="Number of ROIs cropped at the same time, each using "
+                    "its own session",
+        default=1, min=1, max=16),
+
+    scripts.Bool("Shared_Reads", grouping="6",
+        description="Read the pixels of overlapping ROIs once and write "
+                    "the overlapping ROI images plane by plane (uses up "
+                    "to Workers sessions)",
+        default=False),
+
     version="1.0",
     authors=["Alex Herbert"],
     institutions=["GDSC, University of Sussex"],